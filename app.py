@@ -1,11 +1,19 @@
-from init import init_session_state, client
-from threads_handling import sidebar_thread_management
-from interface import main_chat_interface
-
-def main():
-    init_session_state()
-    sidebar_thread_management()
-    main_chat_interface()
-
-if __name__ == "__main__":
-    main()
+from init import init_session_state, client
+from threads_handling import sidebar_thread_management
+from interface import main_chat_interface, metrics_admin_requested, metrics_admin_page
+from metrics import start_metrics_server
+from assistant import ensure_tools_registered
+import streamlit as st
+
+def main():
+    init_session_state()
+    start_metrics_server()
+    ensure_tools_registered(st.secrets["ASSISTANT_ID"])
+    if metrics_admin_requested():
+        metrics_admin_page()
+        return
+    sidebar_thread_management()
+    main_chat_interface()
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,328 @@
-from init import client
-import time
-import json
-from assistant_functions import add_order_row
-
-def wait_for_runs_to_complete(thread_id):
-    runs = client.beta.threads.runs.list(thread_id=thread_id)
-    for run in runs.data:
-        if run.status in ["requires_action", "processing"]:
-            # Wait until the active run is completed with exponential backoff
-            max_attempts = 5
-            for attempt in range(max_attempts):
-                time.sleep(2**attempt)  # Exponential backoff
-                run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run.status in ["completed", "failed"]:
-                    break
-            else:
-                print(f"Run {run.id} still active after {max_attempts} attempts.")
-
-def run_assistant(thread_id, assistant_id):
-    runs = client.beta.threads.runs.list(thread_id=thread_id)
-    for run in runs.data:
-        if run.status in ["requires_action", "processing"]:
-            # Wait until the active run is completed
-            while run.status not in ["completed", "failed"]:
-                time.sleep(2)  # Polling interval
-                run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-
-    # Create a new run
-    run = client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id
-    )
-
-    while True:
-        run = client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id
-        )
-
-        if run.status == "requires_action":
-            required_actions = run.required_action.submit_tool_outputs.model_dump()
-            tool_outputs = []
-
-            for tool_call in required_actions["tool_calls"]:
-                func_name = tool_call['function']['name']
-                arguments = json.loads(tool_call['function']['arguments'])
-
-                if func_name == "add_order_row":
-                    required_params = ['first_name', 'last_name', 'address', 'phone', 'product', 'how_many'] # , 'price'
-                    missing_params = [param for param in required_params if param not in arguments]
-
-                    if missing_params:
-                        raise KeyError(f"Missing required parameters: {', '.join(missing_params)}")
-
-                    output_df = add_order_row(
-                        file_path="./drive/orders.json",
-                        first_name=arguments['first_name'],
-                        last_name=arguments['last_name'],
-                        address=arguments['address'],
-                        phone=arguments['phone'],
-                        product=arguments['product'],
-                 #      price=arguments['price'],
-                        how_many=arguments['how_many']
-                    )
-                    tool_outputs.append({
-                        "tool_call_id": tool_call['id'],
-                        "output": output_df.to_json(orient='records', force_ascii=False)
-                    })
-                else:
-                    raise ValueError(f"Unknown function: {func_name}")
-
-            client.beta.threads.runs.submit_tool_outputs(
-                thread_id=thread_id,
-                run_id=run.id,
-                tool_outputs=tool_outputs
-            )
-        elif run.status == "completed":
-            break
-        elif run.status == "failed":
-            raise Exception(f"Run failed: {run.last_error}")
-        else:
-            print(f"Run status: {run.status}")
-            time.sleep(2)  # Polling interval
-
-    # Fetch messages after the run is completed
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    return messages.data
+from init import client
+import time
+import json
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from assistant_functions import add_order_rows, SEARCH_PRODUCTS_TOOL
+from order_store import ORDERS_DB
+from metrics import span, timed, increment, observe, COUNT_BUCKETS
+
+def register_tools(assistant_id):
+    """Add the local function tools to the assistant, keeping its other tools"""
+    assistant = client.beta.assistants.retrieve(assistant_id)
+    tools = [tool.model_dump(exclude_none=True) for tool in assistant.tools]
+    names = {tool["function"]["name"] for tool in tools if tool["type"] == "function"}
+    if SEARCH_PRODUCTS_TOOL["function"]["name"] not in names:
+        tools.append(SEARCH_PRODUCTS_TOOL)
+        client.beta.assistants.update(assistant_id, tools=tools)
+
+_tools_registered = False
+_register_lock = threading.Lock()
+
+def ensure_tools_registered(assistant_id):
+    """register_tools once per process; a failed attempt is retried on the next call"""
+    global _tools_registered
+    if _tools_registered:
+        return
+    with _register_lock:
+        if _tools_registered:
+            return
+        try:
+            register_tools(assistant_id)
+            _tools_registered = True
+        except Exception as e:
+            print(f"Error registering assistant tools: {e}")
+
+TOOL_WORKERS = 4
+REPLY_MESSAGE_LIMIT = 20
+SEARCH_MAX_RESULTS = 20
+
+# thread id -> id of the newest message already fetched, so listing is incremental
+_last_seen_message_ids = {}
+
+def _add_orders_tool(arguments_list):
+    required_params = ['first_name', 'last_name', 'address', 'phone', 'product', 'how_many'] # , 'price'
+    for arguments in arguments_list:
+        missing_params = [param for param in required_params if param not in arguments]
+        if missing_params:
+            raise KeyError(f"Missing required parameters: {', '.join(missing_params)}")
+
+    # One transaction for every order in this run step
+    inserted = add_order_rows(ORDERS_DB, arguments_list)
+    return [json.dumps(order, ensure_ascii=False) for order in inserted]
+
+def _search_products_tool(arguments):
+    if 'query' not in arguments:
+        raise KeyError("Missing required parameters: query")
+    top_k = max(1, min(int(arguments.get('top_k', 5)), SEARCH_MAX_RESULTS))
+    # Imported lazily: img_search loads torch/transformers
+    from img_search import search_by_text
+    return search_by_text(arguments['query'], top_k=top_k)
+
+# name -> (handler, batched). Batched handlers get every call's arguments at
+# once and return one output per call; the others run once per call.
+TOOL_REGISTRY = {
+    "add_order_row": (_add_orders_tool, True),
+    "search_products_by_text": (_search_products_tool, False),
+}
+
+def _error_output(tool_call_id, func_name, error):
+    print(f"Error in tool {func_name}: {error}")
+    increment("assistant_tool_errors_total", labels={"tool": func_name if func_name in TOOL_REGISTRY else "unknown"})
+    return {"tool_call_id": tool_call_id, "output": f"Error: {error}"}
+
+def _timed(func_name, handler, *args):
+    with span(f"tool.{func_name}"):
+        return handler(*args)
+
+@timed("assistant.tool_calls")
+def handle_tool_calls(tool_calls):
+    """Run the requested tool calls concurrently and return their outputs for submission
+
+    A failing call gets its error text as output instead of raising: every call
+    must be answered, or the run stays in requires_action until it expires.
+    """
+    outputs = [None] * len(tool_calls)
+    batches = {}
+    for position, tool_call in enumerate(tool_calls):
+        func_name = tool_call['function']['name']
+        try:
+            if func_name not in TOOL_REGISTRY:
+                raise ValueError(f"Unknown function: {func_name}")
+            arguments = json.loads(tool_call['function']['arguments'])
+        except ValueError as e:
+            outputs[position] = _error_output(tool_call['id'], func_name, e)
+            continue
+        batches.setdefault(func_name, []).append((position, tool_call['id'], arguments))
+
+    with ThreadPoolExecutor(max_workers=TOOL_WORKERS) as executor:
+        futures = []
+        for func_name, calls in batches.items():
+            handler, batched = TOOL_REGISTRY[func_name]
+            if batched:
+                future = executor.submit(_timed, func_name, handler, [arguments for _, _, arguments in calls])
+                futures.append((future, func_name, calls, True))
+            else:
+                for call in calls:
+                    future = executor.submit(_timed, func_name, handler, call[2])
+                    futures.append((future, func_name, [call], False))
+
+        for future, func_name, calls, batched in futures:
+            try:
+                results = future.result() if batched else [future.result()]
+            except Exception as e:
+                for position, tool_call_id, _ in calls:
+                    outputs[position] = _error_output(tool_call_id, func_name, e)
+                continue
+            for (position, tool_call_id, _), output in zip(calls, results):
+                outputs[position] = {
+                    "tool_call_id": tool_call_id,
+                    "output": output
+                }
+
+    return outputs
+
+def _record_polls(loop, polls):
+    """Count the retrieve calls one polling loop made for one run"""
+    labels = {"loop": loop}
+    increment("assistant_poll_iterations_total", polls, labels)
+    observe("assistant_polls_per_run", polls, labels, COUNT_BUCKETS)
+
+@timed("assistant.wait_for_runs_to_complete")
+def wait_for_runs_to_complete(thread_id):
+    """Wait for active runs on the thread; returns True if none is left active.
+
+    Pass the result to run_assistant/stream_assistant as runs_checked so they
+    don't list the thread's runs a second time.
+    """
+    idle = True
+    runs = client.beta.threads.runs.list(thread_id=thread_id)
+    for run in runs.data:
+        if run.status in ["requires_action", "processing"]:
+            # Wait until the active run is completed with exponential backoff
+            max_attempts = 5
+            polls = 0
+            try:
+                for attempt in range(max_attempts):
+                    time.sleep(2**attempt)  # Exponential backoff
+                    polls += 1
+                    run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+                    if run.status in ["completed", "failed"]:
+                        break
+                else:
+                    print(f"Run {run.id} still active after {max_attempts} attempts.")
+                    idle = False
+            finally:
+                _record_polls("wait_for_runs_to_complete", polls)
+    return idle
+
+@timed("assistant.wait_for_active_runs")
+def wait_for_active_runs(thread_id):
+    runs = client.beta.threads.runs.list(thread_id=thread_id)
+    for run in runs.data:
+        if run.status in ["requires_action", "processing"]:
+            # Wait until the active run is completed
+            polls = 0
+            try:
+                while run.status not in ["completed", "failed"]:
+                    time.sleep(2)  # Polling interval
+                    polls += 1
+                    run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+            finally:
+                _record_polls("wait_for_active_runs", polls)
+
+class StreamingUnavailable(Exception):
+    """Raised when a streamed run could not be started; safe to fall back to polling"""
+
+def stream_assistant(thread_id, assistant_id, runs_checked=False, state=None):
+    """Run the assistant and yield reply text deltas as they arrive.
+
+    Tool calls are answered inline and the run keeps streaming from
+    submit_tool_outputs_stream. Use run_assistant as the polling fallback.
+    If given, `state` receives the run id under 'run_id' so the finished
+    reply can be fetched with fetch_run_messages.
+    """
+    if not runs_checked:
+        wait_for_active_runs(thread_id)
+
+    with ExitStack() as stack:
+        try:
+            events = stack.enter_context(client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=assistant_id
+            ))
+        except Exception as e:
+            raise StreamingUnavailable(str(e)) from e
+
+        with span("assistant.stream"):
+            yield from _stream_events(thread_id, events, state if state is not None else {})
+
+def _stream_events(thread_id, events, state):
+    for event in events:
+        if event.event == "thread.run.created":
+            state['run_id'] = event.data.id
+        elif event.event == "thread.message.delta":
+            for block in event.data.delta.content or []:
+                if block.type == "text" and block.text and block.text.value:
+                    yield block.text.value
+        elif event.event == "thread.run.requires_action":
+            run = event.data
+            required_actions = run.required_action.submit_tool_outputs.model_dump()
+            tool_outputs = handle_tool_calls(required_actions["tool_calls"])
+
+            with client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs
+            ) as tool_events:
+                yield from _stream_events(thread_id, tool_events, state)
+        elif event.event == "thread.run.failed":
+            raise Exception(f"Run failed: {event.data.last_error}")
+
+@timed("assistant.run_assistant")
+def run_assistant(thread_id, assistant_id, runs_checked=False):
+    if not runs_checked:
+        wait_for_active_runs(thread_id)
+
+    # Create a new run
+    run = client.beta.threads.runs.create(
+        thread_id=thread_id,
+        assistant_id=assistant_id
+    )
+
+    polls = 0
+    try:
+        while True:
+            polls += 1
+            run = client.beta.threads.runs.retrieve(
+                thread_id=thread_id,
+                run_id=run.id
+            )
+
+            if run.status == "requires_action":
+                required_actions = run.required_action.submit_tool_outputs.model_dump()
+                tool_outputs = handle_tool_calls(required_actions["tool_calls"])
+
+                client.beta.threads.runs.submit_tool_outputs(
+                    thread_id=thread_id,
+                    run_id=run.id,
+                    tool_outputs=tool_outputs
+                )
+            elif run.status == "completed":
+                break
+            elif run.status == "failed":
+                raise Exception(f"Run failed: {run.last_error}")
+            else:
+                print(f"Run status: {run.status}")
+                time.sleep(2)  # Polling interval
+    finally:
+        # Failed and interrupted runs are counted too
+        _record_polls("run_assistant", polls)
+
+    # Fetch only the messages this run produced
+    return fetch_run_messages(thread_id, run.id)
+
+def fetch_run_messages(thread_id, run_id):
+    """Assistant messages created by one run, oldest first.
+
+    Lists only that run's messages, starting after the last message already
+    seen on the thread, instead of paging through the whole thread.
+    """
+    kwargs = {}
+    last_seen = _last_seen_message_ids.get(thread_id)
+    if last_seen:
+        kwargs['after'] = last_seen
+    messages = client.beta.threads.messages.list(
+        thread_id=thread_id,
+        run_id=run_id,
+        order="asc",
+        limit=REPLY_MESSAGE_LIMIT,
+        **kwargs
+    ).data
+    if messages:
+        _last_seen_message_ids[thread_id] = messages[-1].id
+    return [message for message in messages if message.role == "assistant"]
+
+def reply_blocks(messages):
+    """Every content block of the given messages as plain dicts, in order"""
+    blocks = []
+    for message in messages:
+        for content in message.content:
+            if content.type == "text":
+                blocks.append({
+                    "type": "text",
+                    "text": content.text.value,
+                    "annotations": [_annotation(annotation) for annotation in content.text.annotations or []]
+                })
+            elif content.type == "image_file":
+                blocks.append({"type": "image_file", "file_id": content.image_file.file_id})
+    return blocks
+
+def _annotation(annotation):
+    if annotation.type == "file_citation":
+        file_id = annotation.file_citation.file_id
+    elif annotation.type == "file_path":
+        file_id = annotation.file_path.file_id
+    else:
+        file_id = None
+    return {"type": annotation.type, "text": annotation.text, "file_id": file_id}
+
+def format_reply(blocks):
+    """Join reply blocks into one markdown string, turning citations into [n] footnotes"""
+    parts, sources = [], []
+    for block in blocks:
+        if block["type"] == "text":
+            text = block["text"]
+            for annotation in block["annotations"]:
+                if not annotation["text"]:
+                    continue
+                if annotation["file_id"] not in sources:
+                    sources.append(annotation["file_id"])
+                text = text.replace(annotation["text"], f"[{sources.index(annotation['file_id']) + 1}]")
+            parts.append(text)
+        elif block["type"] == "image_file":
+            parts.append(f"[image: {block['file_id']}]")
+    if sources:
+        parts.append("\n".join(f"[{i}] {file_id}" for i, file_id in enumerate(sources, 1)))
+    return "\n\n".join(parts)
@@ -1,42 +1,60 @@
-import pandas as pd
+from order_store import insert_orders
 from datetime import datetime
 
+SEARCH_PRODUCTS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "search_products_by_text",
+        "description": "Find catalogue products whose images match a text description, using the local CLIP model.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "Short English description of the product, e.g. 'red leather handbag'"
+                },
+                "top_k": {
+                    "type": "integer",
+                    "description": "Number of products to return, 1 to 20 (default 5)"
+                }
+            },
+            "required": ["query"]
+        }
+    }
+}
+
 def format_datetime(iso_datetime):
     """Convert ISO datetime string to a formatted string."""
     dt = datetime.fromisoformat(iso_datetime)
     return dt.strftime("%Y-%m-%d %H:%M")
 
 def add_order_row(file_path, first_name, last_name, address, phone, product, how_many): #, price
-    try:
-        df = pd.read_json(file_path, dtype={
-            'first_name': str,
-            'last_name': str,
-            'address': str,
-            'phone': str,  # Ensure phone is read as string
-            'product': str,
-          # 'price': str,
-            'date': str,
-            'how_many': int
-        })
-    except FileNotFoundError:
-        df = pd.DataFrame(columns=['first_name', 'last_name', 'address', 'phone', 'product', 'date', 'how_many']) # , 'price'
+    return add_order_rows(file_path, [{
+        'first_name': first_name,
+        'last_name': last_name,
+        'address': address,
+        'phone': phone,
+        'product': product,
+    #    'price': price,
+        'how_many': how_many
+    }])[0]
 
+def add_order_rows(file_path, orders):
+    """Append several orders in one transaction; returns only the inserted orders"""
     now = datetime.now()
     date_time_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    new_row = {
-        'first_name': str(first_name),
-        'last_name': str(last_name),
-        'address': str(address),
-        'phone': str(phone),
-        'product': str(product),
-    #    'price': str(price),
+    new_rows = [{
+        'first_name': str(order['first_name']),
+        'last_name': str(order['last_name']),
+        'address': str(order['address']),
+        'phone': str(order['phone']),
+        'product': str(order['product']),
+    #    'price': str(order['price']),
         'date': date_time_str,
-        'how_many': int(how_many)
-    }
-
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+        'how_many': int(order['how_many'])
+    } for order in orders]
 
-    df.to_json(file_path, orient='records', force_ascii=False, date_format='iso')
-    print(f"Order added to {file_path}")
-    return df
+    inserted = insert_orders(new_rows, db_path=file_path)
+    print(f"{len(inserted)} order(s) added to {file_path}")
+    return inserted
@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import types
+import tempfile
+import argparse
+import datetime
+import contextlib
+import subprocess
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def timed_search(index, queries, top_k):
+    """Search one query at a time (as the app does); returns indices and latencies in ms"""
+    indices, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, idx = index.search(query.unsqueeze(0), top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        indices.append(idx[0])
+    return indices, latencies
+
+def latency_summary(latencies):
+    return {
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95)
+    }
+
+def synthetic_features(n, dim=512, seed=0):
+    """Clustered random unit vectors, roughly shaped like a product catalogue"""
+    # torch is only imported by the subcommands that need it
+    import torch
+    import torch.nn.functional as F
+
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(max(1, n // 50), dim, generator=generator)
+    features = centers[torch.randint(centers.shape[0], (n,), generator=generator)]
+    features = features + 0.5 * torch.randn(n, dim, generator=generator)
+    return F.normalize(features, dim=-1)
+
+def make_queries(features, n_queries, noise=0.3, seed=1):
+    """Perturbed catalogue rows, standing in for customer photos of known products"""
+    import torch
+    import torch.nn.functional as F
+
+    generator = torch.Generator().manual_seed(seed)
+    rows = torch.randint(features.shape[0], (n_queries,), generator=generator)
+    queries = features[rows] + noise * torch.randn(n_queries, features.shape[1], generator=generator) / features.shape[1] ** 0.5
+    return F.normalize(queries, dim=-1)
+
+def bench_index(features, n_queries=200, top_k=5, nprobes=(1, 4, 16, 64), nlist=None):
+    """Compare recall@k and latency of the IVF backend against exact flat search"""
+    from feature_index import FlatIndex, IVFIndex
+
+    queries = make_queries(features, n_queries)
+
+    flat = FlatIndex(features)
+    exact, flat_latencies = timed_search(flat, queries, top_k)
+    report = {
+        'catalogue_size': features.shape[0],
+        'queries': n_queries,
+        'top_k': top_k,
+        'backends': [dict(backend='flat', recall_at_k=1.0, **latency_summary(flat_latencies))]
+    }
+
+    start = time.perf_counter()
+    ivf = IVFIndex.build(features, nlist=nlist)
+    report['ivf_build_s'] = time.perf_counter() - start
+    report['ivf_nlist'] = ivf.nlist
+
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        approx, latencies = timed_search(ivf, queries, top_k)
+        hits = sum(len(set(a.tolist()) & set(e.tolist())) for a, e in zip(approx, exact))
+        report['backends'].append(dict(
+            backend='ivf',
+            nprobe=nprobe,
+            recall_at_k=hits / (len(exact) * min(top_k, features.shape[0])),
+            **latency_summary(latencies)
+        ))
+    return report
+
+def bench_encoder(backends, image_files=(), n_images=16, top_k=5, num_threads=None, features_file=None, tolerance=0.9):
+    """Top-k agreement with the fp32 encoder and latency for each encoder backend"""
+    import torch
+    from PIL import Image
+    from clip_encoder import build_image_encoder, check_encoder_accuracy
+    from img_search import initialize_model, load_precomputed_data
+
+    model, processor, device = initialize_model()
+    if image_files:
+        images = [Image.open(path).convert('RGB') for path in image_files]
+    else:
+        images = random_images(n_images)
+    pixel_values = processor(images=images, return_tensors="pt")['pixel_values']
+
+    if features_file:
+        image_features, _, _ = load_precomputed_data(features_file)
+    else:
+        image_features = synthetic_features(10000)
+
+    report = {'images': len(images), 'top_k': top_k, 'tolerance': tolerance, 'backends': []}
+    for backend in backends:
+        encoder = build_image_encoder(model, device, backend, num_threads)
+        latencies = []
+        with torch.no_grad():
+            encoder(pixel_values[:1].to(device))  # warm-up / compilation
+            for row in range(pixel_values.shape[0]):
+                start = time.perf_counter()
+                encoder(pixel_values[row:row + 1].to(device))
+                latencies.append((time.perf_counter() - start) * 1000)
+        result = check_encoder_accuracy(pixel_values, model, device, image_features, backend, top_k, num_threads)
+        result['within_tolerance'] = result['top_k_overlap'] >= tolerance
+        result.update(latency_summary(latencies))
+        report['backends'].append(result)
+    return report
+
+def random_images(n, seed=0):
+    import torch
+    from PIL import Image
+
+    generator = torch.Generator().manual_seed(seed)
+    return [Image.fromarray((torch.rand(224, 224, 3, generator=generator) * 255).byte().numpy()) for _ in range(n)]
+
+def bench_search(sizes, n_queries=20, top_k=5, index_backend='flat', nprobe=None, encoder_backend=None):
+    """Per-stage latency of image search against synthetic catalogues of each size
+
+    Queries go through SearchEngine.search_many, so the timings are the app's
+    own search.encode / search.rank spans for the chosen index and encoder
+    backends. Every query is a distinct image, so the result cache never hits.
+    """
+    from feature_index import DEFAULT_NPROBE, FlatIndex, IVFIndex
+    from clip_encoder import ENCODER_BACKEND
+    from img_search import SearchEngine
+    from metrics import request_trace
+
+    engine = SearchEngine(index_backend=index_backend, nprobe=nprobe or DEFAULT_NPROBE,
+                          encoder_backend=encoder_backend or ENCODER_BACKEND).load_model()
+    images = random_images(n_queries)
+    warm_up_image = random_images(1, seed=1)
+
+    report = {'queries': n_queries, 'top_k': top_k, 'device': str(engine.device),
+              'index_backend': engine.index_backend, 'encoder_backend': engine.encoder_backend, 'sizes': []}
+    for size in sizes:
+        features = synthetic_features(size, engine.model.config.projection_dim)
+        if index_backend == 'ivf':
+            index = IVFIndex.build(features, nprobe=engine.nprobe)
+        else:
+            index = FlatIndex(features)
+        paths = [f"images/{i}.jpg" for i in range(size)]
+        image_index = [{'path': path, 'pID': str(i), 'text': f"product {i}"} for i, path in enumerate(paths)]
+        engine.use_catalogue(features, paths, image_index, index)
+        engine.search_many(warm_up_image, top_k)
+
+        stages = {}
+        for image in images:
+            with request_trace("bench_search") as trace:
+                engine.search_many([image], top_k)
+            for recorded in trace['spans']:
+                stages.setdefault(recorded['stage'], []).append(recorded['ms'])
+
+        report['sizes'].append({
+            'catalogue_size': size,
+            'stages': {stage: latency_summary(latencies) for stage, latencies in stages.items()}
+        })
+    return report
+
+def _install_fake_client(client):
+    """Make `from init import client` resolve to a fake, without Streamlit secrets"""
+    fake_init = types.ModuleType('init')
+    fake_init.client = client
+    fake_init.init_session_state = lambda: None
+    sys.modules['init'] = fake_init
+    for name in ('assistant', 'threads_handling'):
+        if name in sys.modules:
+            sys.modules[name].client = client
+
+def _sample_order(i):
+    return {
+        'first_name': 'Sara', 'last_name': f"Test{i}", 'address': 'Tehran', 'phone': f"0912{i:07d}",
+        'product': f"product-{i % 50}", 'how_many': 1 + i % 3
+    }
+
+def bench_storage(sizes, operations=200):
+    """Order insert and chat-history append throughput as the stored data grows"""
+    from fake_assistants import FakeAssistantsClient
+    _install_fake_client(FakeAssistantsClient())
+    from assistant_functions import add_order_row, add_order_rows
+    from threads_handling import append_chat_messages, load_chat_page
+
+    report = {'operations': operations, 'sizes': []}
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                db_path = "./drive/orders.db"
+                if size:
+                    add_order_rows(db_path, [_sample_order(i) for i in range(size)])
+                start = time.perf_counter()
+                for i in range(operations):
+                    add_order_row(db_path, **_sample_order(size + i))
+                order_seconds = time.perf_counter() - start
+
+                message = {'role': 'user', 'content': 'x' * 200}
+                if size:
+                    append_chat_messages('bench', [message] * size)
+                start = time.perf_counter()
+                for _ in range(operations):
+                    append_chat_messages('bench', [message])
+                chat_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                load_chat_page('bench')
+                tail_ms = (time.perf_counter() - start) * 1000
+            finally:
+                os.chdir(cwd)
+
+        report['sizes'].append({
+            'existing_rows': size,
+            'add_order_row_per_s': operations / order_seconds,
+            'append_chat_message_per_s': operations / chat_seconds,
+            'load_chat_tail_ms': tail_ms
+        })
+    return report
+
+def bench_assistant(turns=20, latency=0.05, in_progress_polls=0):
+    """End-to-end run_assistant latency against the in-process fake Assistants API"""
+    from fake_assistants import FakeAssistantsClient
+
+    scenarios = {
+        'completed': [],
+        'requires_action': [('add_order_row', _sample_order(0))]
+    }
+    report = {'turns': turns, 'api_latency_ms': latency * 1000, 'in_progress_polls': in_progress_polls, 'scenarios': []}
+    cwd = os.getcwd()
+    for name, tool_calls in scenarios.items():
+        client = FakeAssistantsClient(latency=latency, tool_calls=tool_calls, in_progress_polls=in_progress_polls)
+        _install_fake_client(client)
+        import assistant
+        # Message cursors from the previous scenario's fake are meaningless here
+        assistant._last_seen_message_ids.clear()
+
+        latencies = []
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                for _ in range(turns):
+                    start = time.perf_counter()
+                    # Same sequence as a chat turn: post the prompt, then run
+                    client.beta.threads.messages.create(thread_id='thread_bench', role='user', content='hi')
+                    assistant.run_assistant('thread_bench', 'asst_bench')
+                    latencies.append((time.perf_counter() - start) * 1000)
+            finally:
+                os.chdir(cwd)
+
+        report['scenarios'].append(dict(
+            scenario=name,
+            api_calls_per_turn={call: count / turns for call, count in client.calls.items()},
+            messages_listed_per_turn=client.messages_listed / turns,
+            **latency_summary(latencies)
+        ))
+    return report
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the search, assistant and storage hot paths; prints JSON")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="recall@k and latency of flat vs IVF search")
+    index_parser.add_argument('--features', default=None, help="inference.pkl to use instead of synthetic data")
+    index_parser.add_argument('--synthetic', type=int, default=50000, help="synthetic catalogue size")
+    index_parser.add_argument('--queries', type=int, default=200)
+    index_parser.add_argument('--top-k', type=int, default=5)
+    index_parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    index_parser.add_argument('--nlist', type=int, default=None)
+
+    encoder_parser = subparsers.add_parser('encoder', help="accuracy and latency of the CLIP image encoder backends")
+    encoder_parser.add_argument('--backend', nargs='+', default=['eager', 'int8', 'torchscript'])
+    encoder_parser.add_argument('--images', nargs='*', default=[], help="sample images (random images if omitted)")
+    encoder_parser.add_argument('--features', default=None, help="inference.pkl to rank against instead of synthetic data")
+    encoder_parser.add_argument('--top-k', type=int, default=5)
+    encoder_parser.add_argument('--threads', type=int, default=None)
+    encoder_parser.add_argument('--tolerance', type=float, default=0.9, help="minimum mean top-k overlap")
+
+    search_parser = subparsers.add_parser('search', help="per-stage image search latency by catalogue size")
+    search_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    search_parser.add_argument('--queries', type=int, default=20)
+    search_parser.add_argument('--top-k', type=int, default=5)
+    search_parser.add_argument('--index-backend', choices=['flat', 'ivf'], default='flat')
+    search_parser.add_argument('--nprobe', type=int, default=None)
+    search_parser.add_argument('--encoder-backend', default=None, help="clip_encoder backend (default: ENCODER_BACKEND)")
+
+    storage_parser = subparsers.add_parser('storage', help="order and chat-history write throughput by data size")
+    storage_parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10000, 100000])
+    storage_parser.add_argument('--operations', type=int, default=200)
+
+    assistant_parser = subparsers.add_parser('assistant', help="run_assistant latency against a fake Assistants API")
+    assistant_parser.add_argument('--turns', type=int, default=20)
+    assistant_parser.add_argument('--latency-ms', type=float, default=50)
+    assistant_parser.add_argument('--in-progress-polls', type=int, default=0)
+
+    parser.add_argument('--output', default=None, help="also write the JSON report to this file")
+
+    args = parser.parse_args()
+
+    # The app's progress prints go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(args)
+
+    report = dict(
+        benchmark=args.command,
+        git_revision=git_revision(),
+        timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+        **report
+    )
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+def run_benchmark(args):
+    if args.command == 'index':
+        if args.features:
+            from img_search import load_precomputed_data
+            features, _, _ = load_precomputed_data(args.features)
+        else:
+            features = synthetic_features(args.synthetic)
+        report = bench_index(features, args.queries, args.top_k, args.nprobe, args.nlist)
+    elif args.command == 'encoder':
+        report = bench_encoder(args.backend, args.images, top_k=args.top_k, num_threads=args.threads,
+                               features_file=args.features, tolerance=args.tolerance)
+    elif args.command == 'search':
+        report = bench_search(args.sizes, args.queries, args.top_k, args.index_backend, args.nprobe,
+                              args.encoder_backend)
+    elif args.command == 'storage':
+        report = bench_storage(args.sizes, args.operations)
+    elif args.command == 'assistant':
+        report = bench_assistant(args.turns, args.latency_ms / 1000, args.in_progress_polls)
+    return report
+
+if __name__ == "__main__":
+    main()
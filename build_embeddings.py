@@ -0,0 +1,274 @@
+import os
+import io
+import json
+import shutil
+import threading
+import hashlib
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+import embedding_store
+from img_search import initialize_model
+
+def read_image_bytes(location, image_root=None):
+    if is_url(location):
+        with urllib.request.urlopen(location, timeout=30) as response:
+            return response.read()
+    if image_root and not os.path.isabs(location):
+        location = os.path.join(image_root, location)
+    with open(location, 'rb') as f:
+        return f.read()
+
+HASH_CACHE_NAME = 'image_hashes.json'
+DOWNLOADS_NAME = 'downloads.partial'
+
+def is_url(location):
+    return location.startswith(('http://', 'https://'))
+
+def source_key(location, image_root=None):
+    """A cheap fingerprint of the image source: file size/mtime, or the server's ETag.
+
+    None if the source offers nothing to compare, in which case it is re-hashed.
+    """
+    if is_url(location):
+        request = urllib.request.Request(location, method='HEAD')
+        with urllib.request.urlopen(request, timeout=30) as response:
+            headers = response.headers
+        if headers.get('ETag'):
+            return ['etag', headers['ETag']]
+        if headers.get('Last-Modified'):
+            return ['last-modified', headers['Last-Modified'], headers.get('Content-Length')]
+        return None
+    if image_root and not os.path.isabs(location):
+        location = os.path.join(image_root, location)
+    stat = os.stat(location)
+    return ['stat', stat.st_size, stat.st_mtime_ns]
+
+def load_hash_cache(store_dir):
+    """path -> {'key': source_key, 'sha256': ...} from the previous run"""
+    cache_file = os.path.join(store_dir, HASH_CACHE_NAME)
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_hash_cache(store_dir, cache):
+    cache_file = os.path.join(store_dir, HASH_CACHE_NAME)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+def content_hash(row, image_root, cache, known, download_dir):
+    """sha256 of the row's image, or None if it cannot be read.
+
+    The image is only read when its source key changed since the cached hash.
+    Downloaded images that still need embedding are kept in download_dir, so
+    the DataLoader does not fetch them a second time.
+    """
+    location = row['path']
+    try:
+        try:
+            key = source_key(location, image_root)
+        except Exception:
+            key = None
+        cached = cache.get(location)
+        if key is not None and cached and cached['key'] == key:
+            return cached['sha256'], key
+        data = read_image_bytes(location, image_root)
+        sha256 = hashlib.sha256(data).hexdigest()
+        if is_url(location) and sha256 not in known:
+            download = os.path.join(download_dir, sha256)
+            with open(f"{download}.{threading.get_ident()}.tmp", 'wb') as f:
+                f.write(data)
+            os.replace(f.name, download)
+        return sha256, key
+    except Exception as e:
+        print(f"Skipping {location}: {e}")
+        return None, None
+
+class CatalogueImages(Dataset):
+    """Preprocessed pixel values for the catalogue rows that need embedding.
+
+    Loading, decoding and CLIP preprocessing all happen in DataLoader workers.
+    """
+
+    def __init__(self, rows, processor, image_root=None):
+        self.rows = rows
+        self.processor = processor
+        self.image_root = image_root
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        row = self.rows[i]
+        try:
+            if row.get('download'):
+                with open(row['download'], 'rb') as f:
+                    data = f.read()
+            else:
+                data = read_image_bytes(row['path'], self.image_root)
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+        except Exception as e:
+            print(f"Skipping {row['path']}: {e}")
+            return None, row
+        return self.processor(images=image, return_tensors="pt")['pixel_values'][0], row
+
+def collate(batch):
+    batch = [item for item in batch if item[0] is not None]
+    if not batch:
+        return None, []
+    pixel_values, rows = zip(*batch)
+    return torch.stack(pixel_values), list(rows)
+
+def load_existing(store_dir):
+    """sha256 -> feature row of the current store, so unchanged images are reused"""
+    if not embedding_store.store_exists(store_dir):
+        return {}, None
+    try:
+        features, metadata = embedding_store.read_store(store_dir)
+    except ValueError as e:
+        # Includes StoreMismatch: rows of a mismatched store cannot be trusted
+        print(f"Not reusing the existing store: {e}")
+        return {}, None
+    hashes = metadata['columns'].get('sha256', [])
+    return {h: row for row, h in enumerate(hashes) if h}, features
+
+def _truncate(path, size):
+    if os.path.exists(path):
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+def load_partial(partial_features, partial_rows, dim):
+    """Embeddings written by an interrupted run: sha256 -> feature vector
+
+    Both files are cut back to the rows they agree on, so the resumed run
+    appends right after the last complete vector/hash pair.
+    """
+    hashes, row_ends = [], [0]
+    if os.path.exists(partial_rows):
+        with open(partial_rows, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    hashes.append(json.loads(line)['sha256'])
+                except (ValueError, KeyError):
+                    break  # torn write from a crash; later vectors would be misaligned
+                row_ends.append(row_ends[-1] + len(line))
+    features = np.fromfile(partial_features, dtype=np.float32) if os.path.exists(partial_features) else np.empty(0, np.float32)
+    count = min(len(hashes), features.size // dim)
+
+    _truncate(partial_features, count * dim * 4)
+    _truncate(partial_rows, row_ends[count])
+
+    features = features[:count * dim].reshape(count, dim)
+    return {h: torch.from_numpy(features[i].copy()) for i, h in enumerate(hashes[:count])}
+
+def build(csv_file, image_column, id_column, text_column, store_dir, image_root=None,
+          batch_size=32, num_workers=4, dtype='float32'):
+    data = pd.read_csv(csv_file, encoding='utf-8', engine='python')
+    data = data.dropna(subset=[image_column]).drop_duplicates(subset=[image_column])
+    rows = [{
+        'path': str(record[image_column]),
+        'pID': str(record[id_column]),
+        'text': '' if pd.isna(record.get(text_column)) else str(record.get(text_column))
+    } for record in data.to_dict('records')]
+
+    model, processor, device = initialize_model()
+    dim = model.config.projection_dim
+    existing, existing_features = load_existing(store_dir)
+    partial_features = os.path.join(store_dir, 'image_features.partial')
+    partial_rows = os.path.join(store_dir, 'image_metadata.partial.jsonl')
+    resumed = load_partial(partial_features, partial_rows, dim)
+
+    # Hash every image first; only new or changed content goes through CLIP.
+    # Images whose source key is unchanged reuse the hash from the last run.
+    os.makedirs(store_dir, exist_ok=True)
+    download_dir = os.path.join(store_dir, DOWNLOADS_NAME)
+    os.makedirs(download_dir, exist_ok=True)
+    cache = load_hash_cache(store_dir)
+    known = set(existing) | set(resumed)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers) * 4) as executor:
+        hashes = list(executor.map(lambda row: content_hash(row, image_root, cache, known, download_dir), rows))
+    save_hash_cache(store_dir, {
+        row['path']: {'key': key, 'sha256': h}
+        for row, (h, key) in zip(rows, hashes) if h and key is not None
+    })
+    rows = [dict(row, sha256=h) for row, (h, _) in zip(rows, hashes) if h]
+    for row in rows:
+        download = os.path.join(download_dir, row['sha256'])
+        if os.path.exists(download):
+            row['download'] = download
+
+    todo = [row for row in rows if row['sha256'] not in existing and row['sha256'] not in resumed]
+    print(f"{len(rows)} images: {len(rows) - len(todo)} unchanged, {len(todo)} to embed")
+
+    if todo:
+        loader = DataLoader(CatalogueImages(todo, processor, image_root), batch_size=batch_size,
+                            num_workers=num_workers, collate_fn=collate)
+        embedded = 0
+        with open(partial_features, 'ab') as feature_file, open(partial_rows, 'a', encoding='utf-8') as row_file, torch.no_grad():
+            for pixel_values, batch_rows in loader:
+                if not batch_rows:
+                    continue
+                features = F.normalize(model.get_image_features(pixel_values.to(device)).cpu(), dim=-1)
+                # Features first, then rows: a row is only trusted once its vector is on disk
+                feature_file.write(features.numpy().astype(np.float32).tobytes())
+                feature_file.flush()
+                for row, feature in zip(batch_rows, features):
+                    row_file.write(json.dumps({'sha256': row['sha256']}) + "\n")
+                    resumed[row['sha256']] = feature
+                row_file.flush()
+                embedded += len(batch_rows)
+                print(f"Embedded {embedded}/{len(todo)}")
+
+    paths, metadata, vectors = [], [], []
+    for row in rows:
+        if row['sha256'] in resumed:
+            vector = resumed[row['sha256']]
+        elif row['sha256'] in existing:
+            vector = existing_features[existing[row['sha256']]]
+        else:
+            continue  # image failed to decode
+        paths.append(row['path'])
+        metadata.append({key: value for key, value in row.items() if key != 'download'})
+        vectors.append(vector)
+
+    if not vectors:
+        raise ValueError(f"No catalogue image in {csv_file} could be read; the store was not written")
+    embedding_store.write_store(store_dir, torch.stack(vectors), paths, metadata, dtype, source='pipeline')
+    for path in (partial_features, partial_rows):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(download_dir, ignore_errors=True)
+    print(f"Wrote {len(paths)} embeddings to {store_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=(
+        "Embed catalogue images into the search store read by img_search. "
+        "Only new or changed images (by content hash) are embedded; interrupted runs resume."
+    ))
+    parser.add_argument('--csv', default='drive/products.csv')
+    parser.add_argument('--image-column', required=True, help="column holding the image path or URL")
+    parser.add_argument('--id-column', default='product_id')
+    parser.add_argument('--text-column', default='text', help="English description column")
+    parser.add_argument('--image-root', default=None, help="directory relative image paths are resolved against")
+    parser.add_argument('--out', default='drive')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+    args = parser.parse_args()
+
+    build(args.csv, args.image_column, args.id_column, args.text_column, args.out,
+          args.image_root, args.batch_size, args.workers, args.dtype)
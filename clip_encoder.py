@@ -0,0 +1,111 @@
+import os
+import copy
+import torch
+
+ENCODER_BACKEND = 'eager'  # 'eager', 'int8', 'compile', 'torchscript' or 'onnx'
+NUM_THREADS = None  # intra-op threads for CPU inference; None keeps torch's default
+ONNX_FILE = 'drive/clip_vision.onnx'
+BACKENDS = ('eager', 'int8', 'compile', 'torchscript', 'onnx')
+
+class VisionTower(torch.nn.Module):
+    """The image half of CLIPModel: same output as get_image_features"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values):
+        pooled_output = self.vision_model(pixel_values=pixel_values, return_dict=False)[1]
+        return self.visual_projection(pooled_output)
+
+def _example_input(device):
+    return torch.zeros(1, 3, 224, 224, device=device)
+
+def _onnx_encoder(tower, num_threads, onnx_file):
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError(
+            "The 'onnx' encoder backend needs onnxruntime (pip install onnxruntime); "
+            "use another ENCODER_BACKEND or install it"
+        ) from e
+
+    if not os.path.exists(onnx_file):
+        tmp_file = f"{onnx_file}.{os.getpid()}.tmp"
+        torch.onnx.export(
+            tower,
+            (_example_input('cpu'),),
+            tmp_file,
+            input_names=['pixel_values'],
+            output_names=['image_embeds'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}},
+            opset_version=17
+        )
+        os.replace(tmp_file, onnx_file)
+
+    options = ort.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    session = ort.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+
+    def encode(pixel_values):
+        outputs = session.run(None, {'pixel_values': pixel_values.cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+    return encode
+
+def build_image_encoder(model, device, backend=ENCODER_BACKEND, num_threads=NUM_THREADS, onnx_file=ONNX_FILE):
+    """Return a callable mapping pixel_values to image features for the chosen backend.
+
+    Only 'eager' runs on GPU; the other backends are CPU optimizations and
+    fall back to eager when a GPU is in use. The text tower is never touched.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend}")
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if device.type != 'cpu' and backend != 'eager':
+        print(f"Encoder backend {backend} is CPU-only; using eager on {device}")
+        backend = 'eager'
+
+    if backend == 'eager':
+        return lambda pixel_values: model.get_image_features(pixel_values=pixel_values)
+
+    tower = VisionTower(model).eval()
+    if backend == 'int8':
+        # Copy so the shared fp32 weights stay intact for text encoding
+        encoder = torch.ao.quantization.quantize_dynamic(copy.deepcopy(tower), {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'compile':
+        encoder = torch.compile(tower)
+    elif backend == 'torchscript':
+        with torch.no_grad():
+            encoder = torch.jit.freeze(torch.jit.trace(tower, _example_input(device)))
+    else:
+        encoder = _onnx_encoder(tower, num_threads, onnx_file)
+    return encoder
+
+def check_encoder_accuracy(pixel_values, model, device, image_features, backend, top_k=5, num_threads=NUM_THREADS):
+    """Compare a backend's top-k catalogue matches against the fp32 eager encoder.
+
+    Returns the mean top-k overlap (1.0 = identical result sets) and the
+    largest cosine distance between baseline and optimized query features.
+    """
+    baseline = build_image_encoder(model, device, 'eager', num_threads)
+    optimized = build_image_encoder(model, device, backend, num_threads)
+    with torch.no_grad():
+        expected = torch.nn.functional.normalize(baseline(pixel_values.to(device)).cpu().float(), dim=-1)
+        actual = torch.nn.functional.normalize(optimized(pixel_values.to(device)).cpu().float(), dim=-1)
+
+    k = min(top_k, image_features.shape[0])
+    expected_top = torch.topk(torch.matmul(expected, image_features.t()), k, dim=-1).indices
+    actual_top = torch.topk(torch.matmul(actual, image_features.t()), k, dim=-1).indices
+    overlaps = [
+        len(set(e.tolist()) & set(a.tolist())) / k
+        for e, a in zip(expected_top, actual_top)
+    ]
+    return {
+        'backend': backend,
+        'top_k_overlap': sum(overlaps) / len(overlaps),
+        'min_top_k_overlap': min(overlaps),
+        'max_cosine_distance': float((1 - (expected * actual).sum(dim=-1)).max())
+    }
@@ -1,24 +1,139 @@
-import os
-import gdown
-
-def main():
-    file_ides = {
-        'translated_data.csv': '1Y1DW_sY2mnK8Ty080fRtLQ4shMKHOZCG',
-        'inference.pkl' : '1rreJiFhdATJrjgNfeyJFgz1oEhFfvveE',
-        'products.csv' : '1cZm-MVPCVcvkY0FJ9iZpDjSe9JiPIzm7'
-    }
-    
-    os.makedirs('./drive', exist_ok=True)
-    
-    for file in file_ides.keys():
-        url = f"https://drive.google.com/uc?id={file_ides[file]}"
-        output = f"./drive/{file}"
-    
-        if not os.path.exists(output):
-            print(f"Downloading {file} from Google Drive...")
-            gdown.download(url, output, quiet=False)
-        else:
-            print(f"{file} already exists locally.")
-
-if __name__ == "__main__":
-    main()
+import os
+import json
+import shutil
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import gdown
+
+DRIVE_DIR = './drive'
+
+# size/sha256 are checked when set; pin them with `python drive.py --manifest`.
+# Unpinned entries are only checked for presence (a warning is printed).
+MANIFEST = {
+    'translated_data.csv': {'id': '1Y1DW_sY2mnK8Ty080fRtLQ4shMKHOZCG', 'size': None, 'sha256': None},
+    'inference.pkl': {'id': '1rreJiFhdATJrjgNfeyJFgz1oEhFfvveE', 'size': None, 'sha256': None},
+    'products.csv': {'id': '1cZm-MVPCVcvkY0FJ9iZpDjSe9JiPIzm7', 'size': None, 'sha256': None}
+}
+
+_ready = False
+_ready_lock = threading.Lock()
+
+class GoogleDriveSource:
+    def fetch(self, name, entry, part_path):
+        url = f"https://drive.google.com/uc?id={entry['id']}"
+        gdown.download(url, part_path, quiet=False, resume=True)
+
+class LocalSource:
+    """Copy assets from a local directory (tests, offline setups)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, name, entry, part_path):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        with open(os.path.join(self.directory, name), 'rb') as src, open(part_path, 'ab') as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+
+class HTTPSource:
+    """Fetch assets from a plain file server, resuming with Range requests"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def fetch(self, name, entry, part_path):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = urllib.request.Request(f"{self.base_url}/{name}")
+        if offset:
+            request.add_header('Range', f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if offset and e.code == 416:
+                return  # .part is already complete; fetch_asset verifies it
+            raise
+        with response:
+            # Server ignored the Range header: start over
+            mode = 'ab' if offset and response.status == 206 else 'wb'
+            with open(part_path, mode) as dst:
+                shutil.copyfileobj(response, dst)
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def verify(path, entry):
+    """Raise ValueError if the file does not match its manifest entry"""
+    if entry.get('size') is not None and os.path.getsize(path) != entry['size']:
+        raise ValueError(f"{path}: expected {entry['size']} bytes, got {os.path.getsize(path)}")
+    if entry.get('sha256') and sha256sum(path) != entry['sha256']:
+        raise ValueError(f"{path}: sha256 mismatch")
+
+def is_pinned(entry):
+    return entry.get('size') is not None or bool(entry.get('sha256'))
+
+def fetch_asset(name, entry, source, drive_dir=DRIVE_DIR):
+    output = os.path.join(drive_dir, name)
+    if not is_pinned(entry):
+        print(f"Warning: {name} has no size/sha256 in MANIFEST; its integrity is not checked.")
+    if os.path.exists(output):
+        try:
+            verify(output, entry)
+            print(f"{name} already exists locally.")
+            return output
+        except ValueError as e:
+            # Keep the bad copy for inspection and download a fresh one
+            print(f"{e}; moving it aside and downloading again.")
+            os.replace(output, f"{output}.corrupt")
+
+    # Download next to the target and rename only once it is complete and verified
+    part_path = f"{output}.part"
+    print(f"Downloading {name}...")
+    source.fetch(name, entry, part_path)
+    try:
+        verify(part_path, entry)
+    except ValueError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, output)
+    return output
+
+def ensure_assets(source=None, drive_dir=DRIVE_DIR, manifest=MANIFEST, max_workers=3):
+    """Fetch every missing asset concurrently; raises if any fails"""
+    source = source or GoogleDriveSource()
+    os.makedirs(drive_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_asset, name, entry, source, drive_dir) for name, entry in manifest.items()]
+        return [future.result() for future in futures]
+
+def main(source=None):
+    """Make sure the assets are present; only does the work once per process"""
+    global _ready
+    if _ready:
+        return
+    with _ready_lock:
+        if not _ready:
+            ensure_assets(source)
+            _ready = True
+
+def write_manifest(drive_dir=DRIVE_DIR):
+    """Print MANIFEST with the sizes and hashes of the local files filled in"""
+    manifest = {}
+    for name, entry in MANIFEST.items():
+        path = os.path.join(drive_dir, name)
+        manifest[name] = dict(entry, size=os.path.getsize(path), sha256=sha256sum(path))
+    print(json.dumps(manifest, indent=4))
+
+if __name__ == "__main__":
+    import sys
+
+    if '--manifest' in sys.argv:
+        write_manifest()
+    else:
+        main()
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import numpy as np
+import torch
+
+FEATURES_NAME = 'image_features.npy'
+METADATA_NAME = 'image_metadata.json'
+VERSIONS_NAME = 'image_store'
+POINTER_NAME = 'image_store.current'
+HEADER_NAME = 'image_header.json'
+HEADER_KEYS = ('count', 'dim', 'dtype', 'source', 'version')
+
+def _current_version_dir(store_dir):
+    """Directory of the version the pointer names, or None for the legacy flat layout"""
+    try:
+        with open(os.path.join(store_dir, POINTER_NAME), 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(store_dir, VERSIONS_NAME, version)
+
+def _version_time(version):
+    try:
+        return int(version.split('-', 1)[0])
+    except ValueError:
+        return 0
+
+def store_paths(store_dir):
+    root = _current_version_dir(store_dir) or store_dir
+    return os.path.join(root, FEATURES_NAME), os.path.join(root, METADATA_NAME)
+
+def store_exists(store_dir):
+    return all(os.path.exists(path) for path in store_paths(store_dir))
+
+def read_header(store_dir):
+    """count/dim/dtype/source of the current store, without parsing its paths and columns.
+
+    Stores written before the header existed fall back to the full metadata.
+    Returns None if there is no store.
+    """
+    root = _current_version_dir(store_dir) or store_dir
+    for name in (HEADER_NAME, METADATA_NAME):
+        try:
+            with open(os.path.join(root, name), 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            continue
+        return {key: metadata.get(key) for key in HEADER_KEYS}
+    return None
+
+class StoreMismatch(ValueError):
+    """The feature array does not match the metadata written with it"""
+
+def _check_shape(features, header):
+    expected = (header['count'], header['dim'])
+    if tuple(features.shape) != expected:
+        raise StoreMismatch(f"features have shape {tuple(features.shape)}, metadata expects {expected}")
+
+def is_consistent(store_dir, header=None):
+    try:
+        header = header or read_header(store_dir)
+        if header is None:
+            return False
+        _check_shape(np.load(store_paths(store_dir)[0], mmap_mode='r'), header)
+    except (OSError, ValueError, KeyError):
+        return False
+    return True
+
+def store_source(store_dir, header=None):
+    """What wrote the store: 'pickle' (converted) or 'pipeline' (build_embeddings)"""
+    header = header or read_header(store_dir)
+    # Stores written before this field existed were all converted pickles
+    return header.get('source') or 'pickle'
+
+def is_stale(store_dir, source_file):
+    """True if the store is missing or older than the pickle it was made from.
+
+    A store built by the embedding pipeline is never stale with respect to the
+    pickle, so a downloaded inference.pkl cannot overwrite it. A store whose
+    features do not match its metadata is always stale.
+    """
+    try:
+        header = read_header(store_dir)
+    except ValueError:
+        return True
+    if header is None or not store_exists(store_dir) or not is_consistent(store_dir, header):
+        return True
+    if not os.path.exists(source_file) or store_source(store_dir, header) != 'pickle':
+        return False
+    _, metadata_file = store_paths(store_dir)
+    return os.path.getmtime(metadata_file) < os.path.getmtime(source_file)
+
+def _replace_atomically(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def write_store(store_dir, image_features, image_paths, image_metadata, dtype='float32', source='pickle'):
+    """Write features as a contiguous .npy array and metadata as columns.
+
+    image_metadata must be index-aligned with image_paths; rows without
+    metadata may be None. `source` records what produced the store (see
+    store_source). Both files go into a new version directory and the
+    pointer is swapped last, so readers see either the old store or the new
+    one, never a mix. The previous version is kept for readers that already
+    resolved the old pointer; versions older than it are removed.
+    """
+    versions_dir = os.path.join(store_dir, VERSIONS_NAME)
+    previous_dir = _current_version_dir(store_dir)
+    version = f"{time.time_ns()}-{os.getpid()}"
+    version_dir = os.path.join(versions_dir, version)
+    os.makedirs(version_dir)
+    features_file = os.path.join(version_dir, FEATURES_NAME)
+    metadata_file = os.path.join(version_dir, METADATA_NAME)
+    header_file = os.path.join(version_dir, HEADER_NAME)
+
+    if isinstance(image_features, torch.Tensor):
+        image_features = image_features.detach().cpu().numpy()
+    features = np.ascontiguousarray(image_features, dtype=dtype)
+
+    keys = []
+    for item in image_metadata:
+        for key in item or ():
+            if key not in keys:
+                keys.append(key)
+    columns = {key: [item.get(key) if item else None for item in image_metadata] for key in keys}
+
+    metadata = {
+        'count': len(image_paths),
+        'dim': int(features.shape[1]),
+        'dtype': dtype,
+        'source': source,
+        # Unique per write; a cheap key for anything derived from these features
+        'version': version,
+        'paths': list(image_paths),
+        'present': [item is not None for item in image_metadata],
+        'columns': columns
+    }
+
+    def write_features(path):
+        with open(path, 'wb') as f:
+            np.save(f, features)
+
+    def write_metadata(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, default=str)
+
+    def write_header(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({key: metadata[key] for key in HEADER_KEYS}, f)
+
+    def write_pointer(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(version)
+
+    write_features(features_file)
+    write_metadata(metadata_file)
+    write_header(header_file)
+    _replace_atomically(os.path.join(store_dir, POINTER_NAME), write_pointer)
+
+    # Versions newer than the previous one may belong to a concurrent writer
+    oldest_kept = _version_time(os.path.basename(previous_dir)) if previous_dir else 0
+    for name in os.listdir(versions_dir):
+        if _version_time(name) < oldest_kept:
+            shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+
+def read_store(store_dir):
+    """The feature tensor and the parsed metadata dict of the current store.
+
+    The feature array is memory-mapped copy-on-write, so processes share the
+    page cache and nothing is read until it is used. float32 stores are
+    wrapped zero-copy; float16 stores are upcast to float32 in memory.
+    Raises StoreMismatch if the features do not match the metadata.
+    """
+    features_file, metadata_file = store_paths(store_dir)
+    with open(metadata_file, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+
+    features = np.load(features_file, mmap_mode='c')
+    _check_shape(features, metadata)
+    if features.dtype != np.float32:
+        features = features.astype(np.float32)
+    return torch.from_numpy(features), metadata
+
+def load_versioned_store(store_dir):
+    """Load the store as (image_features, image_paths, image_index, version); see read_store
+
+    version identifies this write of the store (None for stores written
+    before versions were recorded).
+    """
+    image_features, metadata = read_store(store_dir)
+    columns = metadata['columns']
+    keys = list(columns)
+    image_index = [
+        {key: columns[key][row] for key in keys}
+        for row, present in enumerate(metadata['present']) if present
+    ]
+    return image_features, metadata['paths'], image_index, metadata.get('version')
+
+def load_store(store_dir):
+    """Load the store as (image_features, image_paths, image_index); see read_store"""
+    return load_versioned_store(store_dir)[:3]
+
+def convert_pickle(pkl_file, store_dir=None, dtype='float32'):
+    """Convert inference.pkl into the memory-mapped store next to it"""
+    from img_search import align_metadata
+
+    store_dir = store_dir or os.path.dirname(pkl_file) or '.'
+    with open(pkl_file, 'rb') as f:
+        data_dict = pickle.load(f)
+    image_paths = data_dict['image_paths']
+    image_metadata = align_metadata(image_paths, data_dict['image_index'])
+    write_store(store_dir, data_dict['image_features'], image_paths, image_metadata, dtype)
+    return store_dir
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert inference.pkl into the memory-mapped embedding store")
+    parser.add_argument('--pkl', default='drive/inference.pkl')
+    parser.add_argument('--out', default=None, help="store directory (defaults to the pickle's directory)")
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+    args = parser.parse_args()
+
+    store_dir = convert_pickle(args.pkl, args.out, args.dtype)
+    print(f"Wrote {FEATURES_NAME} and {METADATA_NAME} to {os.path.dirname(store_paths(store_dir)[0])}")
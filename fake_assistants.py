@@ -0,0 +1,117 @@
+import json
+import time
+import itertools
+from types import SimpleNamespace
+
+class _Dumpable(SimpleNamespace):
+    def model_dump(self):
+        return json.loads(json.dumps(self, default=lambda o: vars(o)))
+
+class FakeAssistantsClient:
+    """In-process stand-in for the parts of client.beta.threads the app uses.
+
+    Each run optionally stops once at requires_action with `tool_calls`, then
+    reports in_progress for `in_progress_polls` retrieves before completing.
+    Every API call sleeps `latency` seconds and is counted in `calls`;
+    `messages_listed` counts the messages returned by messages.list.
+    """
+
+    def __init__(self, latency=0.0, tool_calls=(), in_progress_polls=0, reply="OK"):
+        self.latency = latency
+        self.tool_calls = list(tool_calls)
+        self.in_progress_polls = in_progress_polls
+        self.reply = reply
+        self.calls = {}
+        self.messages_listed = 0
+        self._ids = itertools.count(1)
+        self._runs = {}
+        self._messages = {}
+
+        threads = SimpleNamespace(
+            runs=SimpleNamespace(
+                list=self._wrap('runs.list', self._list_runs),
+                create=self._wrap('runs.create', self._create_run),
+                retrieve=self._wrap('runs.retrieve', self._retrieve_run),
+                submit_tool_outputs=self._wrap('runs.submit_tool_outputs', self._submit_tool_outputs)
+            ),
+            messages=SimpleNamespace(
+                list=self._wrap('messages.list', self._list_messages),
+                create=self._wrap('messages.create', self._create_message)
+            )
+        )
+        self.beta = SimpleNamespace(threads=threads)
+
+    def _wrap(self, name, func):
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.latency:
+                time.sleep(self.latency)
+            return func(*args, **kwargs)
+        return call
+
+    def _message(self, role, text, run_id=None):
+        return SimpleNamespace(
+            id=f"msg_{next(self._ids)}",
+            role=role,
+            run_id=run_id,
+            content=[SimpleNamespace(type="text", text=SimpleNamespace(value=text, annotations=[]))]
+        )
+
+    def _list_runs(self, thread_id, **kwargs):
+        runs = [state['run'] for state in self._runs.values() if state['thread_id'] == thread_id]
+        return SimpleNamespace(data=list(reversed(runs)))
+
+    def _create_run(self, thread_id, assistant_id, **kwargs):
+        run = SimpleNamespace(id=f"run_{next(self._ids)}", status="queued", required_action=None, last_error=None)
+        self._runs[run.id] = {
+            'thread_id': thread_id,
+            'run': run,
+            'needs_tools': bool(self.tool_calls),
+            'polls_left': self.in_progress_polls
+        }
+        return run
+
+    def _retrieve_run(self, thread_id, run_id, **kwargs):
+        state = self._runs[run_id]
+        run = state['run']
+        if run.status in ("completed", "failed"):
+            return run
+        if state['needs_tools']:
+            run.status = "requires_action"
+            run.required_action = _Dumpable(submit_tool_outputs=_Dumpable(tool_calls=[
+                _Dumpable(id=f"call_{i}", type="function", function=_Dumpable(name=name, arguments=json.dumps(arguments)))
+                for i, (name, arguments) in enumerate(self.tool_calls)
+            ]))
+        elif state['polls_left'] > 0:
+            state['polls_left'] -= 1
+            run.status = "in_progress"
+        else:
+            run.status = "completed"
+            self._messages.setdefault(thread_id, []).insert(0, self._message("assistant", self.reply, run_id))
+        return run
+
+    def _submit_tool_outputs(self, thread_id, run_id, tool_outputs, **kwargs):
+        state = self._runs[run_id]
+        state['needs_tools'] = False
+        state['run'].status = "in_progress"
+        state['run'].required_action = None
+        return state['run']
+
+    def _list_messages(self, thread_id, run_id=None, order="desc", after=None, limit=20, **kwargs):
+        # Stored newest first, like the API's default order
+        messages = list(self._messages.get(thread_id, []))
+        if order == "asc":
+            messages.reverse()
+        if after is not None:
+            # Cursor semantics: only messages after `after` in the requested order
+            messages = messages[[message.id for message in messages].index(after) + 1:]
+        if run_id is not None:
+            messages = [message for message in messages if message.run_id == run_id]
+        page = messages[:limit]
+        self.messages_listed += len(page)
+        return SimpleNamespace(data=page)
+
+    def _create_message(self, thread_id, role, content, **kwargs):
+        message = self._message(role, content)
+        self._messages.setdefault(thread_id, []).insert(0, message)
+        return message
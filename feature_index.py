@@ -0,0 +1,178 @@
+import os
+import math
+import hashlib
+import numpy as np
+import torch
+
+DEFAULT_NPROBE = 8
+
+def features_fingerprint(features):
+    """Content hash of the feature matrix, so a saved index can tell it was built for other vectors"""
+    array = np.ascontiguousarray(features.detach().cpu().numpy())
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype}:{array.shape}".encode())
+    digest.update(array)
+    return digest.hexdigest()
+
+class FlatIndex:
+    """Exact search: dense matmul against every catalogue row"""
+    name = 'flat'
+
+    def __init__(self, features):
+        self.features = features
+
+    @property
+    def ntotal(self):
+        return self.features.shape[0]
+
+    def search(self, queries, top_k):
+        """Return (scores, indices), both B x k, best first"""
+        similarities = torch.matmul(queries, self.features.t())
+        return torch.topk(similarities, min(top_k, self.ntotal), dim=-1)
+
+class IVFIndex:
+    """Inverted-file index over the normalized feature matrix.
+
+    Rows are clustered with spherical k-means into `nlist` lists. A query is
+    only scored against the rows of its `nprobe` closest lists, so nprobe is
+    the recall/latency knob (nprobe == nlist is exact search). Vectors are not
+    copied: the index only stores centroids and the row order per list.
+    """
+    name = 'ivf'
+
+    def __init__(self, features, centroids, list_ids, list_offsets, nprobe=DEFAULT_NPROBE):
+        self.features = features
+        self.centroids = centroids
+        self.list_ids = list_ids
+        self.list_offsets = list_offsets
+        self.nprobe = nprobe
+
+    @property
+    def ntotal(self):
+        return self.features.shape[0]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, features, nlist=None, n_iter=20, seed=0, nprobe=DEFAULT_NPROBE):
+        """Cluster the feature matrix and build the inverted lists"""
+        n = features.shape[0]
+        if nlist is None:
+            nlist = max(1, int(4 * math.sqrt(n)))
+        nlist = min(nlist, n)
+
+        generator = torch.Generator().manual_seed(seed)
+        data = features.float()
+        centroids = data[torch.randperm(n, generator=generator)[:nlist]].clone()
+        for _ in range(n_iter):
+            assignments = torch.matmul(data, centroids.t()).argmax(dim=-1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, data)
+            counts = torch.bincount(assignments, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Re-seed empty lists with random rows
+                sums[empty] = data[torch.randint(n, (int(empty.sum()),), generator=generator)]
+            centroids = torch.nn.functional.normalize(sums, dim=-1)
+
+        assignments = torch.matmul(data, centroids.t()).argmax(dim=-1)
+        list_ids = torch.argsort(assignments, stable=True)
+        counts = torch.bincount(assignments, minlength=nlist)
+        list_offsets = torch.zeros(nlist + 1, dtype=torch.long)
+        list_offsets[1:] = torch.cumsum(counts, dim=0)
+        return cls(features, centroids, list_ids, list_offsets, nprobe)
+
+    def search(self, queries, top_k):
+        """Return (scores, indices), both B x k, best first"""
+        nprobe = min(self.nprobe, self.nlist)
+        top_k = min(top_k, self.ntotal)
+        probes = torch.topk(torch.matmul(queries, self.centroids.t()), nprobe, dim=-1).indices
+
+        all_scores = torch.full((queries.shape[0], top_k), float('-inf'))
+        all_indices = torch.zeros((queries.shape[0], top_k), dtype=torch.long)
+        for row, lists in enumerate(probes.tolist()):
+            candidates = torch.cat([
+                self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists
+            ])
+            if candidates.numel() == 0:
+                continue
+            scores = torch.matmul(self.features[candidates], queries[row])
+            k = min(top_k, candidates.numel())
+            best = torch.topk(scores, k)
+            all_scores[row, :k] = best.values
+            all_indices[row, :k] = candidates[best.indices]
+        return all_scores, all_indices
+
+    def save(self, path, fingerprint=None):
+        """Write to a temp file and rename, so concurrent loaders never see a partial index"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({
+            'ntotal': self.ntotal,
+            'dim': self.features.shape[1],
+            'fingerprint': fingerprint or features_fingerprint(self.features),
+            'centroids': self.centroids,
+            'list_ids': self.list_ids,
+            'list_offsets': self.list_offsets
+        }, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, features, nprobe=DEFAULT_NPROBE, fingerprint=None):
+        """Load a saved index; returns None if it was built for other features"""
+        state = torch.load(path)
+        if state['ntotal'] != features.shape[0] or state['dim'] != features.shape[1]:
+            return None
+        # Same shape is not enough: a refreshed catalogue can keep its row count
+        if state.get('fingerprint') != (fingerprint or features_fingerprint(features)):
+            return None
+        return cls(features, state['centroids'], state['list_ids'], state['list_offsets'], nprobe)
+
+def index_path(features_file, backend):
+    """Where a persisted index lives, next to the features file"""
+    return f"{os.path.splitext(features_file)[0]}.{backend}.pt"
+
+def as_index(features_or_index):
+    """Wrap a raw feature tensor in a FlatIndex; pass indexes through"""
+    if hasattr(features_or_index, 'search'):
+        return features_or_index
+    return FlatIndex(features_or_index)
+
+def load_index(features, features_file, backend='flat', nprobe=DEFAULT_NPROBE, nlist=None, fingerprint=None):
+    """Return an index of the given backend, loading or building it as needed
+
+    fingerprint identifies the features a saved index belongs to; pass the
+    store version so loading does not hash (and so page in) the whole
+    memory-mapped matrix. Without one the features are hashed.
+    """
+    if backend == 'flat':
+        return FlatIndex(features)
+    if backend == 'ivf':
+        path = index_path(features_file, backend)
+        fingerprint = fingerprint or features_fingerprint(features)
+        index = None
+        if os.path.exists(path):
+            index = IVFIndex.load(path, features, nprobe, fingerprint)
+        if index is None:
+            print(f"Building IVF index for {features.shape[0]} images...")
+            index = IVFIndex.build(features, nlist=nlist, nprobe=nprobe)
+            index.save(path, fingerprint)
+        return index
+    raise ValueError(f"Unknown index backend: {backend}")
+
+if __name__ == "__main__":
+    import argparse
+    from img_search import FEATURES_FILE, load_versioned_data
+
+    parser = argparse.ArgumentParser(description="Build the IVF index offline from the precomputed features")
+    parser.add_argument('--features', default=FEATURES_FILE)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    image_features, _, _, version = load_versioned_data(args.features)
+    index = IVFIndex.build(image_features, nlist=args.nlist, n_iter=args.iterations)
+    path = index_path(args.features, 'ivf')
+    # Keyed like load_index keys it, so the app picks this index up
+    index.save(path, version)
+    print(f"Saved IVF index with {index.nlist} lists for {index.ntotal} images to {path}")
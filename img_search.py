@@ -1,85 +1,440 @@
-import pandas as pd
-import torch
-import pickle
-import torch.nn.functional as F
-from transformers import CLIPProcessor, CLIPModel
-from PIL import Image
-
-def load_precomputed_data():
-    """Load the precomputed features and metadata"""
-    with open('drive/inference.pkl', 'rb') as f:
-        data_dict = pickle.load(f)
-    return data_dict['image_features'], data_dict['image_paths'], data_dict['image_index']
-
-def initialize_model():
-    """Initialize CLIP model and processor"""
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = model.to(device)
-    model.eval()
-    return model, processor, device
-
-def search_by_image(image, model, processor, device, image_features, image_paths, image_index, top_k=5):
-    """Search for similar images using CLIP"""
-    with torch.no_grad():
-        inputs = processor(images=image, return_tensors="pt")
-        image_features_query = model.get_image_features(inputs['pixel_values'].to(device))
-        image_features_query = F.normalize(image_features_query.cpu(), dim=-1)
-
-        similarities = torch.matmul(image_features_query, image_features.t())[0]
-        top_indices = torch.topk(similarities, min(top_k, len(image_paths))).indices
-
-        results = []
-        for idx in top_indices:
-            img_path = image_paths[idx]
-            for item in image_index:
-                if item['path'] == img_path:
-                    results.append({
-                        'path': img_path,
-                        'similarity': similarities[idx].item(),
-                        'metadata': item
-                    })
-                    break
-        return results
-
-def process_image(image, top_k=5):
-    try:
-        # Load precomputed data
-        image_features, image_paths, image_index = load_precomputed_data()
-        
-        # Initialize model
-        model, processor, device = initialize_model()
-        
-        # Load metadata
-        data = pd.read_csv('drive/translated_data.csv', encoding='utf-8', engine='python')
-        
-        # Search for similar images
-        results = search_by_image(
-            image, 
-            model, 
-            processor, 
-            device, 
-            image_features, 
-            image_paths, 
-            image_index, 
-            top_k
-        )
-        
-        # Format results
-        output_logs = []
-        for i, result in enumerate(results, 1):
-            similarity = f"\n{i}. Similarity: {result['similarity']:.3f}"
-            image_path = f"   Image: {result['path']}"
-            pid = f"   pID: {result['metadata']['pID']}"
-            eng_text = f"   English Text: {result['metadata']['text']}"
-            try:
-                persian_title = f"   Persian Title: {data.loc[data['product_id'] == int(result['metadata']['pID']), 'title'].values[0]}"
-            except:
-                persian_title = "   Persian Title: Not found"
-            
-            output_logs.extend([similarity, pid, eng_text, persian_title])
-        
-        return "\n".join(output_logs)
-    except Exception as e:
-        raise Exception(f"Detailed error: {str(e)}")
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from transformers import CLIPProcessor, CLIPModel
+from PIL import Image
+import embedding_store
+from clip_encoder import ENCODER_BACKEND, NUM_THREADS, build_image_encoder
+from metrics import span, timed, increment
+from feature_index import DEFAULT_NPROBE, as_index, load_index
+
+MODEL_NAME = "openai/clip-vit-base-patch32"
+FEATURES_FILE = 'drive/inference.pkl'
+METADATA_FILE = 'drive/translated_data.csv'
+MAX_BATCH_SIZE = 16
+TEXT_CACHE_SIZE = 1024
+IMAGE_CACHE_SIZE = 256
+IMAGE_CACHE_TTL = 3600  # seconds
+INDEX_BACKEND = 'flat'  # 'flat' (exact) or 'ivf' (approximate, see feature_index.py)
+
+def load_versioned_data(features_file=FEATURES_FILE):
+    """Load the precomputed features and metadata, plus the store's version
+
+    Reads the memory-mapped store next to features_file, converting the pickle
+    into it first if the store is missing or an older conversion of the pickle.
+    A store built by build_embeddings.py is never replaced.
+    """
+    store_dir = os.path.dirname(features_file) or '.'
+    if embedding_store.is_stale(store_dir, features_file):
+        if not os.path.exists(features_file):
+            raise FileNotFoundError(features_file)
+        embedding_store.convert_pickle(features_file, store_dir)
+    return embedding_store.load_versioned_store(store_dir)
+
+def load_precomputed_data(features_file=FEATURES_FILE):
+    """Load the precomputed features and metadata (see load_versioned_data)"""
+    return load_versioned_data(features_file)[:3]
+
+def initialize_model():
+    """Initialize CLIP model and processor"""
+    model = CLIPModel.from_pretrained(MODEL_NAME)
+    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = model.to(device)
+    model.eval()
+    return model, processor, device
+
+def align_metadata(image_paths, image_index):
+    """Return the image_index entry for each row of image_paths (None if missing)"""
+    metadata_by_path = {}
+    for item in image_index:
+        metadata_by_path.setdefault(item['path'], item)
+    return [metadata_by_path.get(path) for path in image_paths]
+
+def build_title_lookup(data):
+    """Map product_id -> Persian title, keeping the first row per product"""
+    titles = {}
+    for product_id, title in zip(data['product_id'], data['title']):
+        try:
+            titles.setdefault(int(product_id), title)
+        except (TypeError, ValueError):
+            continue
+    return titles
+
+def encode_images(images, model, processor, device, encoder=None):
+    """Return L2-normalized CLIP features (B x D, on CPU) for a list of images
+
+    encoder optionally replaces model.get_image_features (see clip_encoder).
+    """
+    with torch.no_grad():
+        inputs = processor(images=images, return_tensors="pt")
+        pixel_values = inputs['pixel_values'].to(device)
+        features = encoder(pixel_values) if encoder else model.get_image_features(pixel_values)
+        return F.normalize(features.cpu(), dim=-1)
+
+def encode_texts(texts, model, processor, device):
+    """Return L2-normalized CLIP text features (B x D, on CPU) for a list of strings"""
+    with torch.no_grad():
+        inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        features = model.get_text_features(
+            input_ids=inputs['input_ids'].to(device),
+            attention_mask=inputs['attention_mask'].to(device)
+        )
+        return F.normalize(features.cpu(), dim=-1)
+
+def normalize_query(query):
+    """Cache key for a text query: lowercased with collapsed whitespace"""
+    return " ".join(str(query).lower().split())
+
+def image_hash(image):
+    """Content hash of a decoded PIL image (same pixels -> same key)"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+class LRUCache:
+    """Small thread-safe LRU mapping with optional TTL and hit/miss counters"""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._items[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._items)
+
+def rank_features(query_features, image_features, image_paths, image_metadata, top_k=5):
+    """Rank the catalogue for each query row; returns one result list per row
+
+    image_features may be the raw feature tensor or an index from feature_index.
+    """
+    top_scores, top_indices = as_index(image_features).search(query_features, top_k)
+    return assemble_results(top_scores, top_indices, image_paths, image_metadata)
+
+def assemble_results(top_scores, top_indices, image_paths, image_metadata):
+    """Turn B x k index search output into result dicts, one list per query"""
+    all_results = []
+    for scores, indices in zip(top_scores.tolist(), top_indices.tolist()):
+        results = []
+        for score, idx in zip(scores, indices):
+            metadata = image_metadata[idx]
+            # Unfilled slots from an approximate index come back as -inf
+            if metadata is None or score == float('-inf'):
+                continue
+            results.append({
+                'path': image_paths[idx],
+                'similarity': score,
+                'metadata': metadata
+            })
+        all_results.append(results)
+    return all_results
+
+def search_by_images(images, model, processor, device, image_features, image_paths, image_metadata, top_k=5, max_batch_size=MAX_BATCH_SIZE):
+    """Search for similar images for several query images at once
+
+    Images are encoded and ranked in chunks of at most max_batch_size to bound
+    memory. Returns one result list per input image, in order.
+    """
+    all_results = []
+    for start in range(0, len(images), max_batch_size):
+        batch = images[start:start + max_batch_size]
+        query_features = encode_images(batch, model, processor, device)
+        all_results.extend(rank_features(query_features, image_features, image_paths, image_metadata, top_k))
+    return all_results
+
+def search_by_image(image, model, processor, device, image_features, image_paths, image_metadata, top_k=5):
+    """Search for similar images using CLIP
+
+    image_metadata must be index-aligned with image_paths (see align_metadata).
+    """
+    return search_by_images([image], model, processor, device, image_features, image_paths, image_metadata, top_k)[0]
+
+class CatalogueSnapshot:
+    """One loaded catalogue: features, index, row-aligned metadata and its result cache.
+
+    Never mutated after construction; SearchEngine swaps in a new snapshot on
+    reload, and each search reads the snapshot once and uses only that.
+    """
+
+    def __init__(self, image_features, feature_index, image_paths, image_index,
+                 image_metadata, titles_by_pid, source_state):
+        self.image_features = image_features
+        self.feature_index = feature_index
+        self.image_paths = image_paths
+        self.image_index = image_index
+        self.image_metadata = image_metadata
+        self.titles_by_pid = titles_by_pid
+        self.source_state = source_state
+        # image hash -> (query embedding, results, top_k the results were ranked for).
+        # Kept per snapshot so results never outlive the catalogue they came from.
+        self.image_cache = LRUCache(IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL)
+
+    def rank(self, query_features, top_k):
+        return rank_features(query_features, self.feature_index, self.image_paths, self.image_metadata, top_k)
+
+class SearchEngine:
+    """Process-wide owner of the CLIP model, feature matrix and product metadata.
+
+    Everything is loaded lazily on first use and shared by all Streamlit
+    sessions. Call `reload()` to pick up new files under ./drive.
+    """
+
+    def __init__(self, features_file=FEATURES_FILE, metadata_file=METADATA_FILE,
+                 index_backend=INDEX_BACKEND, nprobe=DEFAULT_NPROBE,
+                 encoder_backend=ENCODER_BACKEND, num_threads=NUM_THREADS):
+        self.features_file = features_file
+        self.metadata_file = metadata_file
+        self.index_backend = index_backend
+        self.nprobe = nprobe
+        self.encoder_backend = encoder_backend
+        self.num_threads = num_threads
+        self._lock = threading.RLock()
+        self._data = None  # the current CatalogueSnapshot
+        self.model = None
+        self.image_encoder = None
+        self.processor = None
+        self.device = None
+        self.text_cache = LRUCache(TEXT_CACHE_SIZE)
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    def _current_source_state(self):
+        state = []
+        _, store_metadata_file = embedding_store.store_paths(os.path.dirname(self.features_file) or '.')
+        for path in (self.features_file, store_metadata_file, self.metadata_file):
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def _load_data(self):
+        image_features, image_paths, image_index, version = load_versioned_data(self.features_file)
+        # Taken after loading, since the first load may (re)write the store
+        source_state = self._current_source_state()
+        data = pd.read_csv(self.metadata_file, encoding='utf-8', engine='python')
+        feature_index = load_index(image_features, self.features_file, self.index_backend, self.nprobe,
+                                   fingerprint=version)
+        self.use_catalogue(image_features, image_paths, image_index, feature_index,
+                           build_title_lookup(data), source_state)
+
+    def use_catalogue(self, image_features, image_paths, image_index, feature_index=None,
+                      titles_by_pid=None, source_state=None):
+        """Swap in a catalogue; _load_data uses this for the files under ./drive.
+
+        Also lets the benchmarks search a synthetic catalogue through the same code.
+        """
+        # Row-aligned lookup tables so a hit maps straight to its metadata
+        image_metadata = align_metadata(image_paths, image_index)
+        # One assignment, so concurrent searches see either the old snapshot or the new one
+        self._data = CatalogueSnapshot(image_features, feature_index or as_index(image_features), image_paths,
+                                       image_index, image_metadata, titles_by_pid or {}, source_state)
+
+    def ensure_loaded(self):
+        """Load the model and data once; later calls return immediately"""
+        if self.is_loaded and self.model is not None:
+            return self
+        with self._lock:
+            self.load_model()
+            if not self.is_loaded:
+                self._load_data()
+        return self
+
+    def load_model(self):
+        """Load the CLIP model and image encoder once, without touching the data"""
+        with self._lock:
+            if self.model is None:
+                model, self.processor, self.device = initialize_model()
+                self.image_encoder = build_image_encoder(model, self.device, self.encoder_backend, self.num_threads)
+                self.model = model
+        return self
+
+    def warm_up(self):
+        """Load everything and run dummy forward passes so the first real search is hot"""
+        self.ensure_loaded()
+        blank = Image.new('RGB', (224, 224))
+        encode_images([blank], self.model, self.processor, self.device, self.image_encoder)
+        encode_texts(["product"], self.model, self.processor, self.device)
+        return self
+
+    def reload(self, force=False):
+        """Reload features and metadata if the files under ./drive changed.
+
+        The model itself is kept. Returns True if the data was reloaded.
+        """
+        if not self.is_loaded:
+            self.ensure_loaded()
+            return True
+        if not force and self._current_source_state() == self._data.source_state:
+            return False
+        with self._lock:
+            if force or self._current_source_state() != self._data.source_state:
+                self._load_data()
+                return True
+        return False
+
+    def search(self, image, top_k=5):
+        return self.search_many([image], top_k)[0]
+
+    def search_many(self, images, top_k=5, max_batch_size=MAX_BATCH_SIZE):
+        """Batched image search; repeat images are served from image_cache"""
+        self.ensure_loaded()
+        snap = self._data
+        images = list(images)
+        keys = [image_hash(image) for image in images]
+        all_results = [None] * len(images)
+
+        misses = []
+        for i, key in enumerate(keys):
+            cached = snap.image_cache.get(key)
+            increment("search_image_cache_total", labels={"result": "miss" if cached is None else "hit"})
+            if cached is not None and cached[2] >= top_k:
+                all_results[i] = cached[1][:top_k]
+            elif cached is not None:
+                # Embedding is reusable, only the ranking needs more results
+                all_results[i] = self._rank_and_cache(snap, key, cached[0], top_k)
+            else:
+                misses.append(i)
+
+        for start in range(0, len(misses), max_batch_size):
+            batch = misses[start:start + max_batch_size]
+            with span("search.encode"):
+                query_features = encode_images([images[i] for i in batch], self.model, self.processor, self.device, self.image_encoder)
+            with span("search.rank"):
+                batch_results = snap.rank(query_features, top_k)
+            for i, embedding, results in zip(batch, query_features, batch_results):
+                snap.image_cache.put(keys[i], (embedding, results, top_k))
+                all_results[i] = results
+        return all_results
+
+    def _rank_and_cache(self, snap, key, embedding, top_k):
+        results = snap.rank(embedding.unsqueeze(0), top_k)[0]
+        snap.image_cache.put(key, (embedding, results, top_k))
+        return results
+
+    def encode_text(self, query):
+        """Normalized text embedding for a query, cached by normalized string"""
+        key = normalize_query(query)
+        embedding = self.text_cache.get(key)
+        if embedding is None:
+            self.ensure_loaded()
+            embedding = encode_texts([key], self.model, self.processor, self.device)[0]
+            self.text_cache.put(key, embedding)
+        return embedding
+
+    def search_text(self, query, top_k=5):
+        """Search the image catalogue with a text description"""
+        self.ensure_loaded()
+        snap = self._data
+        embedding = self.encode_text(query)
+        return snap.rank(embedding.unsqueeze(0), top_k)[0]
+
+    def persian_title(self, pID):
+        return self._data.titles_by_pid[int(pID)]
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Return the shared SearchEngine, creating it on first use"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = SearchEngine()
+    return _engine
+
+def format_results(engine, results):
+    """Render a result list as the text block sent to the assistant"""
+    output_logs = []
+    for i, result in enumerate(results, 1):
+        similarity = f"\n{i}. Similarity: {result['similarity']:.3f}"
+        image_path = f"   Image: {result['path']}"
+        pid = f"   pID: {result['metadata']['pID']}"
+        eng_text = f"   English Text: {result['metadata']['text']}"
+        try:
+            persian_title = f"   Persian Title: {engine.persian_title(result['metadata']['pID'])}"
+        except:
+            persian_title = "   Persian Title: Not found"
+
+        output_logs.extend([similarity, pid, eng_text, persian_title])
+
+    return "\n".join(output_logs)
+
+@timed("search.process_image")
+def process_image(image, top_k=5):
+    try:
+        engine = get_engine()
+        # Cheap stat() check; only reloads when ./drive files were replaced
+        engine.reload()
+
+        # Search for similar images
+        results = engine.search(image, top_k)
+
+        return format_results(engine, results)
+    except Exception as e:
+        raise Exception(f"Detailed error: {str(e)}")
+
+def process_images(images, top_k=5, max_batch_size=MAX_BATCH_SIZE):
+    """Batched variant of process_image; returns one text block per image"""
+    try:
+        engine = get_engine()
+        engine.reload()
+
+        all_results = engine.search_many(images, top_k, max_batch_size)
+
+        return [format_results(engine, results) for results in all_results]
+    except Exception as e:
+        raise Exception(f"Detailed error: {str(e)}")
+
+@timed("search.search_by_text")
+def search_by_text(query, top_k=5):
+    """Text counterpart of process_image: look products up by description"""
+    try:
+        engine = get_engine()
+        engine.reload()
+
+        results = engine.search_text(query, top_k)
+
+        return format_results(engine, results)
+    except Exception as e:
+        raise Exception(f"Detailed error: {str(e)}")
@@ -1,15 +1,17 @@
-from openai import OpenAI
 import streamlit as st
+from metrics import instrument_client
+from openai_client import create_client
 
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# One pooled, rate-limit-aware client shared by every session in the process
+client = create_client(st.secrets["OPENAI_API_KEY"], wrap=instrument_client)
 
 def init_session_state():
     if "current_thread_id" not in st.session_state:
         st.session_state.current_thread_id = None
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "orders" not in st.session_state:
-        st.session_state.orders = []
+    if "history_cursor" not in st.session_state:
+        st.session_state.history_cursor = 0
     if "is_request_active" not in st.session_state:
         st.session_state.is_request_active = False
     if "image_uploaded" not in st.session_state:
@@ -1,142 +1,257 @@
-from assistant import wait_for_runs_to_complete, run_assistant
-from threads_handling import save_chat_history
-from drive import main as drive_main
-from img_search import process_image
-from init import client
-import streamlit as st
-from PIL import Image
-import os
-import json
-
-def main_chat_interface():
-    st.title("Image Search with CLIP & AI Chat")
-
-    # Download required files
-    st.header("Downloading Required Files")
-    with st.spinner('Downloading files...'):
-        try:
-            drive_main()
-            st.success("All required files are ready.")
-        except Exception as e:
-            st.error(f"Error in downloading files: {e}")
-            st.stop()
-
-    # Load orders from JSON file
-    orders_file = "./drive/orders.json"
-    if os.path.exists(orders_file):
-        with open(orders_file, 'r') as f:
-            st.session_state.orders = json.load(f)
-
-    # Display orders
-    st.header("Submitted Orders")
-    if st.session_state.orders:
-        st.dataframe(st.session_state.orders)
-    else:
-        st.write("No orders submitted yet.")
-
-    if st.session_state.current_thread_id:
-        # Image upload and processing
-        st.header("Image Search")
-        with st.expander("Upload and Search Image"):
-            uploaded_file = st.file_uploader("Upload an image", type=["jpg", "png", "jpeg"], key="image_uploader")
-
-            if uploaded_file and st.session_state.current_image != uploaded_file:
-                st.session_state.current_image = uploaded_file
-                st.session_state.image_uploaded = False
-
-            if st.session_state.current_image and not st.session_state.image_uploaded:
-                try:
-                    image = Image.open(st.session_state.current_image).convert('RGB')
-                    st.image(image, caption='Uploaded Image.', use_container_width=True)
-
-                    with st.spinner('Processing image...'):
-                        logs = process_image(image, top_k=5)
-                        st.text("Search Results:")
-                        st.text(logs)
-
-                    if not st.session_state.is_request_active:
-                        st.session_state.is_request_active = True
-                        try:
-                            wait_for_runs_to_complete(st.session_state.current_thread_id)
-                            with st.spinner('Sending results to assistant...'):
-                                client.beta.threads.messages.create(
-                                    thread_id=st.session_state.current_thread_id,
-                                    role="user",
-                                    content=f"Image search results: {logs}"
-                                )
-                                st.success("Results sent to assistant.")
-
-                            with st.spinner('Waiting for assistant...'):
-                                messages = run_assistant(st.session_state.current_thread_id, st.secrets["ASSISTANT_ID"])
-                                if messages and len(messages) > 0:
-                                    assistant_response = messages[0].content[0].text.value
-                                    st.session_state.messages.append({
-                                        "role": "user",
-                                        "content": "Similarity search results by local model on uploaded image: " + logs
-                                    })
-                                    st.session_state.messages.append({
-                                        "role": "assistant",
-                                        "content": assistant_response
-                                    })
-                                    save_chat_history(st.session_state.current_thread_id, st.session_state.messages)
-                                    st.session_state.is_request_active = False
-                                else:
-                                    st.warning("No response received from the assistant.")
-                                    st.session_state.is_request_active = False
-                        except Exception as e:
-                            st.error(f"Failed to send message or fetch response: {e}")
-                            st.session_state.is_request_active = False
-                        finally:
-                            st.session_state.image_uploaded = True
-                except Exception as e:
-                    st.error(f"Error processing image: {e}")
-
-        # Chat Interface
-        st.header("Chat with AI Assistant")
-
-        # Display chat history
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.write(message["content"])
-
-        if st.session_state.is_request_active:
-            st.info("Please wait for the current request to complete before sending a new message.")
-        else:
-            prompt = st.chat_input("Type your message here")
-
-            if prompt:
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                with st.chat_message("user"):
-                    st.write(prompt)
-
-                st.session_state.is_request_active = True
-                try:
-                    wait_for_runs_to_complete(st.session_state.current_thread_id)
-                    with st.spinner('Sending message...'):
-                        client.beta.threads.messages.create(
-                            thread_id=st.session_state.current_thread_id,
-                            role="user",
-                            content=prompt
-                        )
-                        st.success("Message sent successfully!")
-
-                    with st.spinner('Waiting for assistant...'):
-                        messages = run_assistant(st.session_state.current_thread_id, st.secrets["ASSISTANT_ID"])
-                        if messages and len(messages) > 0:
-                            assistant_response = messages[0].content[0].text.value
-                            st.session_state.messages.append({
-                                "role": "assistant",
-                                "content": assistant_response
-                            })
-                            save_chat_history(st.session_state.current_thread_id, st.session_state.messages)
-                            with st.chat_message("assistant"):
-                                st.write(assistant_response)
-                            st.session_state.is_request_active = False
-                        else:
-                            st.warning("No response received from the assistant.")
-                            st.session_state.is_request_active = False
-                except Exception as e:
-                    st.error(f"Error: {e}")
-                    st.session_state.is_request_active = False
-    else:
-        st.info("Please select a thread from the sidebar or create a new one to start chatting.")
+from assistant import wait_for_runs_to_complete, run_assistant, stream_assistant, StreamingUnavailable, fetch_run_messages, reply_blocks, format_reply
+from threads_handling import append_chat_messages, load_chat_page
+from drive import main as drive_main
+from warmup import start_warmup, status as warmup_status
+from init import client
+from metrics import request_trace, snapshot as metrics_snapshot, render_prometheus
+from order_store import orders_version, query_orders, orders_per_product, units_per_day
+import hmac
+import streamlit as st
+from PIL import Image
+
+USE_STREAMING = True
+WARMUP_ON_START = True
+
+def get_assistant_reply(thread_id, runs_checked=False):
+    """Stream the assistant's reply into a chat bubble, polling if streaming is unavailable
+
+    runs_checked is wait_for_runs_to_complete's result for this turn.
+    """
+    assistant_id = st.secrets["ASSISTANT_ID"]
+    with st.chat_message("assistant"):
+        if USE_STREAMING:
+            state = {}
+            try:
+                streamed = st.write_stream(stream_assistant(thread_id, assistant_id, runs_checked, state))
+            except StreamingUnavailable as e:
+                print(f"Streaming unavailable, falling back to polling: {e}")
+            else:
+                # Re-read the finished messages to pick up every block and its citations
+                if state.get('run_id'):
+                    blocks = reply_blocks(fetch_run_messages(thread_id, state['run_id']))
+                    if blocks:
+                        return format_reply(blocks)
+                return streamed or None
+
+        messages = run_assistant(thread_id, assistant_id, runs_checked)
+        if messages and len(messages) > 0:
+            assistant_response = format_reply(reply_blocks(messages))
+            st.write(assistant_response)
+            return assistant_response
+        return None
+
+ORDERS_PAGE_SIZE = 50
+
+# The version argument is the store's write counter: it is part of the cache
+# key, so cached pages are reused across reruns until an order is written.
+@st.cache_data(max_entries=128)
+def cached_orders_page(version, filters, page, page_size):
+    return query_orders(**filters, limit=page_size, offset=page * page_size)
+
+@st.cache_data(max_entries=32)
+def cached_order_summaries(version, filters):
+    return orders_per_product(**filters), units_per_day(**filters)
+
+def orders_panel():
+    st.header("Submitted Orders")
+    version = orders_version()
+
+    with st.expander("Filter orders"):
+        col1, col2, col3 = st.columns(3)
+        product = col1.text_input("Product contains", key="orders_product")
+        phone = col2.text_input("Phone contains", key="orders_phone")
+        dates = col3.date_input("Date range", value=(), key="orders_dates")
+    filters = {
+        "product": product or None,
+        "phone": phone or None,
+        "date_from": dates[0].isoformat() if len(dates) > 0 else None,
+        "date_to": dates[-1].isoformat() if len(dates) > 0 else None
+    }
+
+    page = st.session_state.get("orders_page", 1) - 1
+    orders, total = cached_orders_page(version, filters, page, ORDERS_PAGE_SIZE)
+    if not total:
+        if any(filters.values()):
+            st.write("No orders match these filters.")
+        else:
+            st.write("No orders submitted yet.")
+        return
+
+    pages = (total + ORDERS_PAGE_SIZE - 1) // ORDERS_PAGE_SIZE
+    if page >= pages:
+        # Filters shrank the result; jump to the last page that exists
+        st.session_state.orders_page = pages
+        orders, total = cached_orders_page(version, filters, pages - 1, ORDERS_PAGE_SIZE)
+    st.dataframe(orders)
+    st.number_input(f"Page (of {pages}, {total} orders)", min_value=1, max_value=pages, step=1, key="orders_page")
+
+    with st.expander("Order summaries"):
+        per_product, per_day = cached_order_summaries(version, filters)
+        col1, col2 = st.columns(2)
+        col1.write("Orders per product")
+        col1.dataframe(per_product)
+        col2.write("Units per day")
+        if per_day:
+            col2.bar_chart(per_day, x="day", y="units")
+
+def metrics_admin_requested():
+    """True for ?admin=metrics&token=<METRICS_ADMIN_TOKEN>; off unless that secret is set"""
+    if st.query_params.get("admin") != "metrics":
+        return False
+    expected = st.secrets.get("METRICS_ADMIN_TOKEN")
+    token = st.query_params.get("token", "")
+    return bool(expected) and hmac.compare_digest(token.encode(), str(expected).encode())
+
+def metrics_admin_page():
+    """Admin view of the process metrics (see metrics_admin_requested)"""
+    st.title("Metrics")
+    counters, histograms = metrics_snapshot()
+    st.header("Counters")
+    st.dataframe(counters)
+    st.header("Stage latencies and per-run counts")
+    st.dataframe(histograms)
+    with st.expander("Prometheus text"):
+        st.code(render_prometheus(), language="text")
+
+def main_chat_interface():
+    st.title("Image Search with CLIP & AI Chat")
+
+    # Download required files
+    st.header("Downloading Required Files")
+    with st.spinner('Downloading files...'):
+        try:
+            drive_main()
+            st.success("All required files are ready.")
+            if WARMUP_ON_START:
+                start_warmup()
+        except Exception as e:
+            st.error(f"Error in downloading files: {e}")
+            st.stop()
+
+    orders_panel()
+
+    if st.session_state.current_thread_id:
+        # Image upload and processing
+        st.header("Image Search")
+        if warmup_status() == "warming":
+            st.caption("Image search model is loading in the background...")
+        elif warmup_status() == "ready":
+            st.caption("Image search model is ready.")
+        with st.expander("Upload and Search Image"):
+            uploaded_file = st.file_uploader("Upload an image", type=["jpg", "png", "jpeg"], key="image_uploader")
+
+            if uploaded_file and st.session_state.current_image != uploaded_file:
+                st.session_state.current_image = uploaded_file
+                st.session_state.image_uploaded = False
+
+            if st.session_state.current_image and not st.session_state.image_uploaded:
+                try:
+                    image = Image.open(st.session_state.current_image).convert('RGB')
+                    st.image(image, caption='Uploaded Image.', use_container_width=True)
+
+                    with st.spinner('Processing image...'):
+                        # Imported lazily so chat-only sessions never load torch
+                        from img_search import process_image
+                        logs = process_image(image, top_k=5)
+                        st.text("Search Results:")
+                        st.text(logs)
+
+                    if not st.session_state.is_request_active:
+                        st.session_state.is_request_active = True
+                        with request_trace("image_turn"):
+                            try:
+                                runs_checked = wait_for_runs_to_complete(st.session_state.current_thread_id)
+                                with st.spinner('Sending results to assistant...'):
+                                    client.beta.threads.messages.create(
+                                        thread_id=st.session_state.current_thread_id,
+                                        role="user",
+                                        content=f"Image search results: {logs}"
+                                    )
+                                    st.success("Results sent to assistant.")
+
+                                # Stream the reply live, then leave it to the chat history below
+                                live_reply = st.empty()
+                                with live_reply.container():
+                                    assistant_response = get_assistant_reply(st.session_state.current_thread_id, runs_checked)
+                                live_reply.empty()
+
+                                if assistant_response:
+                                    new_messages = [{
+                                        "role": "user",
+                                        "content": "Similarity search results by local model on uploaded image: " + logs
+                                    }, {
+                                        "role": "assistant",
+                                        "content": assistant_response
+                                    }]
+                                    st.session_state.messages.extend(new_messages)
+                                    append_chat_messages(st.session_state.current_thread_id, new_messages)
+                                    st.session_state.is_request_active = False
+                                else:
+                                    st.warning("No response received from the assistant.")
+                                    st.session_state.is_request_active = False
+                            except Exception as e:
+                                st.error(f"Failed to send message or fetch response: {e}")
+                                st.session_state.is_request_active = False
+                            finally:
+                                st.session_state.image_uploaded = True
+                except Exception as e:
+                    st.error(f"Error processing image: {e}")
+
+        # Chat Interface
+        st.header("Chat with AI Assistant")
+
+        # Older messages are only read from disk on request
+        if st.session_state.history_cursor:
+            if st.button("Load older messages"):
+                older, st.session_state.history_cursor = load_chat_page(
+                    st.session_state.current_thread_id,
+                    before=st.session_state.history_cursor
+                )
+                st.session_state.messages = older + st.session_state.messages
+
+        # Display chat history
+        for message in st.session_state.messages:
+            with st.chat_message(message["role"]):
+                st.write(message["content"])
+
+        if st.session_state.is_request_active:
+            st.info("Please wait for the current request to complete before sending a new message.")
+        else:
+            prompt = st.chat_input("Type your message here")
+
+            if prompt:
+                st.session_state.messages.append({"role": "user", "content": prompt})
+                with st.chat_message("user"):
+                    st.write(prompt)
+
+                st.session_state.is_request_active = True
+                with request_trace("chat_turn"):
+                    try:
+                        runs_checked = wait_for_runs_to_complete(st.session_state.current_thread_id)
+                        with st.spinner('Sending message...'):
+                            client.beta.threads.messages.create(
+                                thread_id=st.session_state.current_thread_id,
+                                role="user",
+                                content=prompt
+                            )
+                            st.success("Message sent successfully!")
+                        # Persisted as soon as it is in the thread, even if the run then fails
+                        append_chat_messages(st.session_state.current_thread_id, [{"role": "user", "content": prompt}])
+
+                        assistant_response = get_assistant_reply(st.session_state.current_thread_id, runs_checked)
+                        if assistant_response:
+                            assistant_msg = {
+                                "role": "assistant",
+                                "content": assistant_response
+                            }
+                            st.session_state.messages.append(assistant_msg)
+                            append_chat_messages(st.session_state.current_thread_id, [assistant_msg])
+                            st.session_state.is_request_active = False
+                        else:
+                            st.warning("No response received from the assistant.")
+                            st.session_state.is_request_active = False
+                    except Exception as e:
+                        st.error(f"Error: {e}")
+                        st.session_state.is_request_active = False
+    else:
+        st.info("Please select a thread from the sidebar or create a new one to start chatting.")
@@ -0,0 +1,189 @@
+import json
+import time
+import functools
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACE_LOGGING = False  # print every span of a request as one JSON line
+METRICS_PORT = None  # serve /metrics in Prometheus text format on this port
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_local = threading.local()
+_server = None
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+def increment(name, amount=1, labels=None):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, labels=None, buckets=LATENCY_BUCKETS_MS):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+@contextlib.contextmanager
+def span(stage):
+    """Time a block into the stage_latency_ms histogram (and the current trace)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        observe("stage_latency_ms", elapsed_ms, {"stage": stage})
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            trace['spans'].append({'stage': stage, 'ms': round(elapsed_ms, 2)})
+
+def timed(stage):
+    """Decorator form of span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def request_trace(name):
+    """Collect the spans of one user request; printed on exit if TRACE_LOGGING is on.
+
+    Yields the trace dict, which is complete once the block exits.
+    """
+    outer = getattr(_local, 'trace', None)
+    trace = _local.trace = {'request': name, 'spans': [], 'api_calls': 0}
+    start = time.perf_counter()
+    try:
+        with span(f"request.{name}"):
+            yield trace
+    finally:
+        _local.trace = outer
+        trace['total_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        observe("openai_calls_per_request", trace['api_calls'], {"request": name}, COUNT_BUCKETS)
+        if TRACE_LOGGING:
+            print(json.dumps(trace))
+
+def is_api_resource(obj):
+    """True for the OpenAI client and its resource namespaces (client.beta.threads, ...)"""
+    return hasattr(obj, 'with_raw_response')
+
+class _InstrumentedResource:
+    """Proxy over the OpenAI client that counts and times every API method call"""
+
+    def __init__(self, target, path=""):
+        self._target = target
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}" if self._path else name
+        if not callable(attr):
+            # Plain values (api_key, base_url, ...) are returned unchanged
+            return _InstrumentedResource(attr, path) if is_api_resource(attr) else attr
+
+        def call(*args, **kwargs):
+            increment("openai_api_calls_total", labels={"endpoint": path})
+            trace = getattr(_local, 'trace', None)
+            if trace is not None:
+                trace['api_calls'] += 1
+            with span(f"openai.{path}"):
+                return attr(*args, **kwargs)
+        return call
+
+def instrument_client(client):
+    return _InstrumentedResource(client)
+
+def snapshot():
+    """Counters and histogram summaries as plain data, for the admin page"""
+    with _lock:
+        counters = [
+            {'name': name, **dict(labels), 'value': value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+        histograms = [
+            {'name': name, **dict(labels), 'count': h.count, 'mean': h.sum / h.count if h.count else 0.0}
+            for (name, labels), h in sorted(_histograms.items())
+        ]
+    return counters, histograms
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(_counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), h in sorted(_histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(h.buckets, h.bucket_counts):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=None):
+    """Serve /metrics on a daemon thread; does nothing if no port is configured"""
+    global _server
+    port = port or METRICS_PORT
+    with _lock:
+        if _server is not None or not port:
+            return
+        _server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
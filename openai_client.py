@@ -0,0 +1,137 @@
+import time
+import random
+import threading
+import httpx
+import openai
+from metrics import increment, is_api_resource
+
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+MAX_CONCURRENT_REQUESTS = 8  # shared by every session in the process
+MAX_RETRIES = 5
+BASE_BACKOFF = 0.5  # seconds
+MAX_BACKOFF = 20.0
+TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.InternalServerError
+)
+# Only these are safe to resend after the request may have reached the server;
+# everything else (messages.create, runs.create, submit_tool_outputs, ...) is a POST
+IDEMPOTENT_METHODS = {"retrieve", "list"}
+
+def _may_retry(error, idempotent):
+    """Read timeouts and dropped connections are only retried for idempotent calls.
+
+    The server may already have processed a POST that timed out, so resending
+    it could duplicate a message or collide with the run it started. A failed
+    connect never reached the server and is always safe to retry.
+    """
+    if idempotent or not isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout))
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said so"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than Retry-After"""
+    delay = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, MAX_BACKOFF * 3))
+    return delay
+
+def call_with_retries(func, *args, idempotent=True, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with _request_slots:
+                return func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES or not _may_retry(e, idempotent):
+                raise
+            increment("openai_retries_total", labels={"error": type(e).__name__})
+            time.sleep(backoff_delay(attempt, e))
+
+class _ResilientStream:
+    """Stream manager whose request, made on enter, goes through call_with_retries.
+
+    The request slot is only held while the stream is opened, not while it is
+    read: a run stream stays open while its tool outputs are submitted on a
+    second stream, and holding both slots could exhaust the semaphore.
+    """
+
+    def __init__(self, open_manager):
+        self._open_manager = open_manager
+        self._manager = None
+
+    def __enter__(self):
+        def enter():
+            # A fresh manager per attempt; a failed one cannot be re-entered
+            manager = self._open_manager()
+            stream = manager.__enter__()
+            self._manager = manager
+            return stream
+        # Opening a stream creates a run or submits tool outputs
+        return call_with_retries(enter, idempotent=False)
+
+    def __exit__(self, *exc_info):
+        return self._manager.__exit__(*exc_info)
+
+class _ResilientResource:
+    """Proxy that runs every API method through the shared semaphore and retry policy"""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return _ResilientResource(attr) if is_api_resource(attr) else attr
+
+        if name == "stream" or name.endswith("_stream"):
+            # These only build a stream manager; the HTTP request happens on enter
+            def open_stream(*args, **kwargs):
+                return _ResilientStream(lambda: attr(*args, **kwargs))
+            return open_stream
+
+        idempotent = name in IDEMPOTENT_METHODS
+
+        def call(*args, **kwargs):
+            return call_with_retries(attr, *args, idempotent=idempotent, **kwargs)
+        return call
+
+def create_client(api_key, wrap=None):
+    """OpenAI client with a pooled HTTP connection, timeouts and our own retries.
+
+    The SDK's built-in retries are disabled so that every retry goes through
+    call_with_retries (jittered, Retry-After aware, concurrency limited).
+    `wrap` is applied to the raw client before the retry layer, so an
+    instrumentation wrapper sees every attempt.
+    """
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        timeout=TIMEOUT
+    )
+    client = openai.OpenAI(api_key=api_key, http_client=http_client, timeout=TIMEOUT, max_retries=0)
+    if wrap is not None:
+        client = wrap(client)
+    return _ResilientResource(client)
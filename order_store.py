@@ -0,0 +1,164 @@
+import os
+import json
+import sqlite3
+import threading
+import contextlib
+
+ORDERS_DB = "./drive/orders.db"
+LEGACY_ORDERS_FILE = "./drive/orders.json"
+COLUMNS = ['first_name', 'last_name', 'address', 'phone', 'product', 'date', 'how_many'] # , 'price'
+
+# db path -> connection shared by every thread; Streamlit runs each rerun on a
+# new thread, so per-thread connections would be reopened on every rerun
+_connections = {}
+_lock = threading.RLock()
+
+def _create_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT,
+            last_name TEXT,
+            address TEXT,
+            phone TEXT,
+            product TEXT,
+            date TEXT,
+            how_many INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS orders_product ON orders (product)")
+    conn.execute("CREATE INDEX IF NOT EXISTS orders_phone ON orders (phone)")
+    conn.execute("CREATE INDEX IF NOT EXISTS orders_date ON orders (date)")
+    # Bumped on every write so readers can cache until something changes
+    conn.execute("CREATE TABLE IF NOT EXISTS orders_version (version INTEGER NOT NULL)")
+    conn.execute("INSERT INTO orders_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM orders_version)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS orders_version_{event.lower()} AFTER {event} ON orders
+            BEGIN UPDATE orders_version SET version = version + 1; END
+        """)
+
+@contextlib.contextmanager
+def connect(db_path=ORDERS_DB):
+    """The process-wide connection to the orders database, locked for the block.
+
+    Opened on first use, which also enables WAL, creates the schema and
+    imports a legacy orders.json.
+    """
+    db_path = os.path.abspath(db_path)
+    with _lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            try:
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                _create_schema(conn)
+                legacy_file = os.path.join(os.path.dirname(db_path) or '.', os.path.basename(LEGACY_ORDERS_FILE))
+                migrate_json(conn, legacy_file)
+            except Exception:
+                conn.close()
+                raise
+            _connections[db_path] = conn
+        yield conn
+
+def migrate_json(conn, json_path):
+    """Import an old orders.json into an empty database, then set the file aside"""
+    if not os.path.exists(json_path):
+        return 0
+    # BEGIN IMMEDIATE serializes concurrent migrations from other processes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = []
+        empty = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+        if empty and os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+            conn.executemany(
+                f"INSERT INTO orders ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(row.get(column) for column in COLUMNS) for row in rows]
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        os.replace(json_path, json_path + ".migrated")
+    except FileNotFoundError:
+        pass
+    if rows:
+        print(f"Migrated {len(rows)} order(s) from {json_path}")
+    return len(rows)
+
+def insert_orders(orders, db_path=ORDERS_DB):
+    """Atomically append orders; returns them as stored, with their ids"""
+    with connect(db_path) as conn:
+        inserted = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for order in orders:
+                cursor = conn.execute(
+                    f"INSERT INTO orders ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    tuple(order[column] for column in COLUMNS)
+                )
+                inserted.append({'id': cursor.lastrowid, **{column: order[column] for column in COLUMNS}})
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return inserted
+
+def orders_version(db_path=ORDERS_DB):
+    """Counter that changes whenever the orders table is written"""
+    with connect(db_path) as conn:
+        return conn.execute("SELECT version FROM orders_version").fetchone()[0]
+
+def _where(product=None, phone=None, date_from=None, date_to=None):
+    clauses, params = [], []
+    if product:
+        clauses.append("product LIKE ?")
+        params.append(f"%{product}%")
+    if phone:
+        clauses.append("phone LIKE ?")
+        params.append(f"%{phone}%")
+    if date_from:
+        clauses.append("date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        # Dates are stored as 'YYYY-MM-DD HH:MM:SS'; include the whole end day
+        clauses.append("date < ?")
+        params.append(f"{date_to}~")
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def query_orders(product=None, phone=None, date_from=None, date_to=None, limit=50, offset=0, db_path=ORDERS_DB):
+    """One page of matching orders (newest first) and the total match count"""
+    with connect(db_path) as conn:
+        where, params = _where(product, phone, date_from, date_to)
+        total = conn.execute(f"SELECT COUNT(*) FROM orders{where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT id, {', '.join(COLUMNS)} FROM orders{where} ORDER BY id DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        return [dict(row) for row in rows], total
+
+def orders_per_product(product=None, phone=None, date_from=None, date_to=None, db_path=ORDERS_DB):
+    with connect(db_path) as conn:
+        where, params = _where(product, phone, date_from, date_to)
+        rows = conn.execute(
+            f"SELECT product, COUNT(*) AS orders, SUM(how_many) AS units FROM orders{where} "
+            "GROUP BY product ORDER BY orders DESC",
+            params
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+def units_per_day(product=None, phone=None, date_from=None, date_to=None, db_path=ORDERS_DB):
+    with connect(db_path) as conn:
+        where, params = _where(product, phone, date_from, date_to)
+        rows = conn.execute(
+            f"SELECT substr(date, 1, 10) AS day, SUM(how_many) AS units FROM orders{where} "
+            "GROUP BY day ORDER BY day",
+            params
+        ).fetchall()
+        return [dict(row) for row in rows]
@@ -1,123 +1,304 @@
-from assistant_functions import format_datetime
-from datetime import datetime
-from init import client
-import streamlit as st
-import json
-import os
-
-
-def load_threads():
-    thread_file = "./drive/threads.json"
-    if os.path.exists(thread_file):
-        with open(thread_file, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_threads(threads):
-    thread_file = "./drive/threads.json"
-    os.makedirs(os.path.dirname(thread_file), exist_ok=True)
-    with open(thread_file, 'w') as f:
-        json.dump(threads, f)
-
-def load_chat_history(thread_id):
-    history_file = f"./drive/chat_history/{thread_id}.json"
-    if os.path.exists(history_file):
-        with open(history_file, 'r') as f:
-            return json.load(f)
-    return []
-
-def save_chat_history(thread_id, messages):
-    history_file = f"./drive/chat_history/{thread_id}.json"
-    os.makedirs(os.path.dirname(history_file), exist_ok=True)
-    with open(history_file, 'w') as f:
-        json.dump(messages, f)
-
-def create_new_thread(thread_name):
-    threads = load_threads()
-
-    # Check for duplicate names
-    existing_names = [thread_info["name"].lower() for thread_info in threads.values()]
-    if thread_name.lower() in existing_names:
-        raise ValueError("A thread with this name already exists")
-
-    thread = client.beta.threads.create(tool_resources={"file_search": {"vector_store_ids": [st.secrets["VECTORSTORE_ID"]] }} )
-    threads[thread.id] = {
-        "name": thread_name,
-        "created_at": datetime.now().isoformat()
-    }
-    save_threads(threads)
-    return thread.id
-
-def sidebar_thread_management():
-    st.sidebar.title("Threads")
-
-    # Create new thread
-    with st.sidebar.expander("Create New Thread", expanded=False):
-        thread_name = st.text_input("Thread Name")
-        if st.button("Create Thread"):
-            if thread_name:
-                try:
-                    thread_id = create_new_thread(thread_name)
-                    st.session_state.current_thread_id = thread_id
-                    st.session_state.messages = []
-                    st.success(f"Created new thread: {thread_name}")
-                    st.rerun()
-                except ValueError as e:
-                    st.error(str(e))
-            else:
-                st.error("Please enter a thread name")
-
-    # List existing threads
-    threads = load_threads()
-    st.sidebar.markdown("### Your Threads")
-
-    # Custom CSS for thread buttons
-    st.markdown("""
-        <style>
-        .thread-timestamp {
-            font-size: 12px;
-            color: #666;
-            text-align: right;
-            padding-top: 4px;
-        }
-        .thread-container {
-            border: 1px solid #ddd;
-            border-radius: 4px;
-            padding: 8px;
-            margin-bottom: 8px;
-        }
-        .thread-name {
-            font-size: 16px;
-            margin-bottom: 4px;
-        }
-        </style>
-    """, unsafe_allow_html=True)
-
-    # Sort threads by creation date (newest first)
-    sorted_threads = sorted(
-        threads.items(),
-        key=lambda x: x[1]['created_at'],
-        reverse=True
-    )
-
-    for thread_id, thread_info in sorted_threads:
-        # Create a container for each thread
-        with st.sidebar.container():
-            # Use HTML for custom styling
-            st.markdown(f"""
-                <div class="thread-container" onclick="window.location.href='#{thread_id}'">
-                    <div class="thread-name">{thread_info['name']}</div>
-                    <div class="thread-timestamp">{format_datetime(thread_info['created_at'])}</div>
-                </div>
-            """, unsafe_allow_html=True)
-
-            # Hidden button for functionality
-            if st.button(
-                thread_info['name'],
-                key=thread_id,
-                use_container_width=True,
-                type="secondary"
-            ):
-                st.session_state.current_thread_id = thread_id
-                st.session_state.messages = load_chat_history(thread_id)
-                st.rerun()
+from assistant_functions import format_datetime
+from datetime import datetime
+from init import client
+import streamlit as st
+import threading
+import json
+import os
+
+
+THREAD_FILE = "./drive/threads.json"
+THREADS_PAGE_SIZE = 20
+
+def load_threads():
+    thread_file = THREAD_FILE
+    if os.path.exists(thread_file):
+        with open(thread_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_threads(threads):
+    thread_file = THREAD_FILE
+    os.makedirs(os.path.dirname(thread_file), exist_ok=True)
+    tmp_file = f"{thread_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(threads, f)
+    os.replace(tmp_file, thread_file)
+
+def _last_activity(thread_id):
+    """Modification time of the thread's chat log, or None if it has none yet"""
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(_history_file(thread_id))).isoformat()
+    except OSError:
+        return None
+
+class ThreadRegistry:
+    """Cached view of threads.json with a name index and a pre-sorted listing.
+
+    The listing is ordered by last activity (falling back to creation time),
+    newest first. Last activity is not stored in threads.json: it is read from
+    the chat log mtimes when the cache is rebuilt and kept in memory after
+    that, so a chat turn never rewrites the thread list. The cache is rebuilt
+    when threads.json changes on disk and updated in place on writes made
+    through the registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._file_state = None
+        self._threads = {}
+        self._names = set()
+        self._activity = {}
+        self._ordered = []
+
+    def _disk_state(self):
+        try:
+            stat = os.stat(THREAD_FILE)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self):
+        state = self._disk_state()
+        if state == self._file_state and self._file_state is not None:
+            return
+        threads = load_threads()
+        self._threads = threads
+        self._names = {thread_info["name"].lower() for thread_info in threads.values()}
+        self._activity = {thread_id: _last_activity(thread_id) for thread_id in threads}
+        self._ordered = sorted(threads.items(), key=self._sort_key, reverse=True)
+        self._file_state = state
+
+    def _sort_key(self, item):
+        thread_id, thread_info = item
+        return self._activity.get(thread_id) or thread_info['created_at']
+
+    def _save(self):
+        save_threads(self._threads)
+        self._file_state = self._disk_state()
+
+    def _move_to_front(self, thread_id):
+        self._ordered = [item for item in self._ordered if item[0] != thread_id]
+        self._ordered.insert(0, (thread_id, self._threads[thread_id]))
+
+    def has_name(self, name):
+        with self._lock:
+            self._refresh()
+            return name.lower() in self._names
+
+    def add(self, thread_id, name):
+        with self._lock:
+            self._refresh()
+            self._threads[thread_id] = {
+                "name": name,
+                "created_at": datetime.now().isoformat()
+            }
+            self._names.add(name.lower())
+            self._move_to_front(thread_id)
+            self._save()
+
+    def touch(self, thread_id):
+        """Record activity on a thread so it sorts to the top (in memory only)"""
+        with self._lock:
+            self._refresh()
+            if thread_id not in self._threads:
+                return
+            self._activity[thread_id] = datetime.now().isoformat()
+            self._move_to_front(thread_id)
+
+    def last_active(self, thread_id, thread_info):
+        """When the thread was last used, or created if it has no activity yet"""
+        with self._lock:
+            return self._sort_key((thread_id, thread_info))
+
+    def listing(self, query=None, offset=0, limit=THREADS_PAGE_SIZE):
+        """A page of (thread_id, thread_info), newest first, and the match count"""
+        with self._lock:
+            self._refresh()
+            items = self._ordered
+        if query:
+            query = query.lower()
+            items = [item for item in items if query in item[1]["name"].lower()]
+        return items[offset:offset + limit], len(items)
+
+registry = ThreadRegistry()
+
+CHAT_HISTORY_DIR = "./drive/chat_history"
+HISTORY_PAGE_SIZE = 50
+_READ_CHUNK = 64 * 1024
+
+def _history_file(thread_id):
+    return f"{CHAT_HISTORY_DIR}/{thread_id}.jsonl"
+
+def _migrate_legacy_history(thread_id):
+    """Convert an old whole-file {thread_id}.json history into the JSONL log"""
+    legacy_file = f"{CHAT_HISTORY_DIR}/{thread_id}.json"
+    history_file = _history_file(thread_id)
+    if not os.path.exists(legacy_file) or os.path.exists(history_file):
+        return
+    with open(legacy_file, 'r') as f:
+        messages = json.load(f)
+    tmp_file = f"{history_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        for message in messages:
+            f.write(json.dumps(message) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, history_file)
+    os.replace(legacy_file, legacy_file + ".migrated")
+
+def append_chat_messages(thread_id, messages):
+    """Append messages to the thread's log and fsync, without rewriting it"""
+    history_file = _history_file(thread_id)
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    _migrate_legacy_history(thread_id)
+    with open(history_file, 'ab') as f:
+        data = "".join(json.dumps(message) + "\n" for message in messages).encode()
+        # A crash mid-append can leave a torn last line; start on a fresh one
+        if f.tell() > 0:
+            with open(history_file, 'rb') as r:
+                r.seek(-1, os.SEEK_END)
+                if r.read(1) != b"\n":
+                    data = b"\n" + data
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    registry.touch(thread_id)
+
+def _parse_lines(lines):
+    messages = []
+    for line in lines:
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            continue  # torn write from a crash
+    return messages
+
+def load_chat_page(thread_id, limit=HISTORY_PAGE_SIZE, before=None):
+    """Load up to `limit` messages ending at byte offset `before` (default: end of log).
+
+    Reads the log backwards, so only the requested tail is touched. Returns
+    (messages, cursor); pass cursor as `before` to fetch the previous page.
+    A cursor of 0 means there is nothing older.
+    """
+    _migrate_legacy_history(thread_id)
+    history_file = _history_file(thread_id)
+    if not os.path.exists(history_file):
+        return [], 0
+
+    with open(history_file, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size if before is None else before
+        start = end
+        buffer = b""
+        # Stop once we hold limit complete lines plus the newline before them
+        while start > 0 and buffer.count(b"\n") <= limit:
+            read_size = min(_READ_CHUNK, start)
+            start -= read_size
+            f.seek(start)
+            buffer = f.read(read_size) + buffer
+
+    lines = buffer.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    if len(lines) > limit:
+        dropped = lines[:len(lines) - limit]
+        start += sum(len(line) + 1 for line in dropped)
+        lines = lines[len(lines) - limit:]
+    return _parse_lines(line for line in lines if line.strip()), start
+
+def load_chat_history(thread_id):
+    """The thread's full history, oldest first"""
+    _migrate_legacy_history(thread_id)
+    history_file = _history_file(thread_id)
+    if os.path.exists(history_file):
+        with open(history_file, 'rb') as f:
+            return _parse_lines(line for line in f if line.strip())
+    return []
+
+def create_new_thread(thread_name):
+    # Check for duplicate names
+    if registry.has_name(thread_name):
+        raise ValueError("A thread with this name already exists")
+
+    thread = client.beta.threads.create(tool_resources={"file_search": {"vector_store_ids": [st.secrets["VECTORSTORE_ID"]] }} )
+    registry.add(thread.id, thread_name)
+    return thread.id
+
+def sidebar_thread_management():
+    st.sidebar.title("Threads")
+
+    # Create new thread
+    with st.sidebar.expander("Create New Thread", expanded=False):
+        thread_name = st.text_input("Thread Name")
+        if st.button("Create Thread"):
+            if thread_name:
+                try:
+                    thread_id = create_new_thread(thread_name)
+                    st.session_state.current_thread_id = thread_id
+                    st.session_state.messages = []
+                    st.session_state.history_cursor = 0
+                    st.success(f"Created new thread: {thread_name}")
+                    st.rerun()
+                except ValueError as e:
+                    st.error(str(e))
+            else:
+                st.error("Please enter a thread name")
+
+    # List existing threads
+    st.sidebar.markdown("### Your Threads")
+    query = st.sidebar.text_input("Search threads", key="thread_search")
+    if st.session_state.get("thread_search_last") != query:
+        st.session_state.thread_search_last = query
+        st.session_state.threads_shown = THREADS_PAGE_SIZE
+    shown = st.session_state.get("threads_shown", THREADS_PAGE_SIZE)
+    visible_threads, total = registry.listing(query, limit=shown)
+
+    # Custom CSS for thread buttons
+    st.markdown("""
+        <style>
+        .thread-timestamp {
+            font-size: 12px;
+            color: #666;
+            text-align: right;
+            padding-top: 4px;
+        }
+        .thread-container {
+            border: 1px solid #ddd;
+            border-radius: 4px;
+            padding: 8px;
+            margin-bottom: 8px;
+        }
+        .thread-name {
+            font-size: 16px;
+            margin-bottom: 4px;
+        }
+        </style>
+    """, unsafe_allow_html=True)
+
+    # Only the visible page is rendered; the registry keeps the sorted order
+    for thread_id, thread_info in visible_threads:
+        # Create a container for each thread
+        with st.sidebar.container():
+            # Use HTML for custom styling
+            st.markdown(f"""
+                <div class="thread-container" onclick="window.location.href='#{thread_id}'">
+                    <div class="thread-name">{thread_info['name']}</div>
+                    <div class="thread-timestamp">{format_datetime(registry.last_active(thread_id, thread_info))}</div>
+                </div>
+            """, unsafe_allow_html=True)
+
+            # Hidden button for functionality
+            if st.button(
+                thread_info['name'],
+                key=thread_id,
+                use_container_width=True,
+                type="secondary"
+            ):
+                st.session_state.current_thread_id = thread_id
+                st.session_state.messages, st.session_state.history_cursor = load_chat_page(thread_id)
+                st.rerun()
+
+    if total > shown:
+        if st.sidebar.button(f"Show more ({total - shown} more)", key="threads_show_more"):
+            st.session_state.threads_shown = shown + THREADS_PAGE_SIZE
+            st.rerun()
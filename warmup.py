@@ -0,0 +1,37 @@
+import threading
+
+# Importing img_search pulls in torch and transformers, so it only happens
+# here (on the warm-up thread) or lazily on the first search.
+_status = "idle"
+_error = None
+_lock = threading.Lock()
+
+def _warm_up():
+    global _status, _error
+    try:
+        from img_search import get_engine
+        get_engine().warm_up()
+        _status = "ready"
+    except Exception as e:
+        _error = e
+        _status = "failed"
+        print(f"Search engine warm-up failed: {e}")
+
+def start_warmup():
+    """Load the search engine on a background thread; safe to call on every rerun"""
+    global _status
+    with _lock:
+        if _status != "idle":
+            return
+        _status = "warming"
+    threading.Thread(target=_warm_up, name="search-warmup", daemon=True).start()
+
+def status():
+    """One of 'idle', 'warming', 'ready' or 'failed'"""
+    return _status
+
+def is_ready():
+    return _status == "ready"
+
+def last_error():
+    return _error